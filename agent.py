@@ -1,19 +1,19 @@
-import streamlit as st
+from rag import RETRIEVER_K, get_conversational_rag_chain
 
-from rag import get_conversational_rag_chain
 
-
-def llm_stream(agent, messages):
-    response_message = ""
+def llm_stream(agent, messages, on_tool_call=None, callbacks=None):
     skip_next_text = False  # flag para ignorar el resultado de las herramientas
 
-    for token, metadata in agent.stream({"messages": messages}, stream_mode="messages"):
+    for token, metadata in agent.stream(
+        {"messages": messages},
+        config={"callbacks": callbacks},
+        stream_mode="messages",
+    ):
         node = metadata["langgraph_node"]
         content_blocks = token.content_blocks
 
         # Procesar cada bloque de contenido
         for block in content_blocks:
-            print(block)
             block_type = block.get("type")
 
             if block_type == "text" and "text" in block:
@@ -22,37 +22,36 @@ def llm_stream(agent, messages):
                     skip_next_text = False
                     continue    # ignorar
                 
-                text_chunk = block["text"]
-                response_message += text_chunk
-                yield text_chunk  # Enviar solo el texto a Streamlit
+                yield block["text"]  # Enviar solo el texto
 
-            elif block_type == "tool_call":
-                # Mostrar cuando se están usando herramientas
+            # en modo "messages" las llamadas llegan como tool_call_chunk
+            elif block_type in ("tool_call", "tool_call_chunk"):
+                # Avisar cuando se están usando herramientas
                 tool_name = block.get("name", "desconocida")
-                if tool_name and tool_name != "desconocida":
-                    st.toast(f"Usando herramienta: {tool_name}")
+                if tool_name and tool_name != "desconocida" and on_tool_call:
+                    on_tool_call(tool_name)
                 skip_next_text = True
 
             elif block_type == "tool_result":
                 continue  # Saltar los resultados de herramientas
 
-    # Guardar mensaje completo al final
-    st.session_state.messages.append({"role": "assistant", "content": response_message})
 
-
-def stream_llm_rag_response(llm_stream, messages):
+def stream_llm_rag_response(
+    llm_stream, messages, vector_db, k=RETRIEVER_K, callbacks=None
+):
     """Stream RAG real con fuentes al final."""
 
     # Limitar historial
     limited_messages = messages[-6:] if len(messages) > 6 else messages
 
-    conversation_rag_chain = get_conversational_rag_chain(llm_stream)
-    response_message = ""
+    conversation_rag_chain = get_conversational_rag_chain(llm_stream, vector_db, k)
     sources = set()
 
     # Stream con captura de contexto
     for chunk in conversation_rag_chain.stream(
-        {"messages": limited_messages[:-1], "input": limited_messages[-1].content}
+        # create_history_aware_retriever solo reescribe la consulta con `chat_history`
+        {"chat_history": limited_messages[:-1], "input": limited_messages[-1].content},
+        config={"callbacks": callbacks},
     ):
         # Capturar documentos del contexto (llegan primero)
         if "context" in chunk and not sources:
@@ -67,15 +66,8 @@ def stream_llm_rag_response(llm_stream, messages):
 
         # Stream de la respuesta
         if "answer" in chunk:
-            answer_chunk = chunk["answer"]
-            response_message += answer_chunk
-            yield answer_chunk
+            yield chunk["answer"]
 
     # Agregar fuentes al final
     if sources:
-        sources_text = "\n\n**Fuentes:** " + ", ".join(sorted(sources))
-        response_message += sources_text
-        yield sources_text
-
-    # Guardar mensaje completo
-    st.session_state.messages.append({"role": "assistant", "content": response_message})
+        yield "\n\n**Fuentes:** " + ", ".join(sorted(sources))
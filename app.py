@@ -1,16 +1,107 @@
-from datetime import datetime
 from uuid import uuid4
 
 import streamlit as st
-from langchain.agents import create_agent
-from langchain.messages import AIMessage, HumanMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
 
-from agent import llm_stream, stream_llm_rag_response
+from chat_store import (
+    HISTORY_PAGE_SIZE,
+    has_older_messages,
+    is_conversation_owner,
+    list_conversations,
+    load_messages,
+)
+from engine import Engine, EngineError, NotFoundError
+from ingest import DONE, FAILED, QUEUED, RUNNING
+from ratelimit import get_scheduler
+from usage import BUDGET_HARD, BUDGET_SOFT, budget_status, session_tokens
+
+INGEST_STATUS_ICONS = {QUEUED: "⏳", RUNNING: "⚙️", DONE: "✅", FAILED: "🚨"}
+
+
+@st.cache_resource
+def get_engine():
+    # Un solo Engine por proceso, compartido por todas las sesiones de Streamlit
+    return Engine()
+
+
+def ingest_uploads(session):
+    for doc_file in st.session_state.rag_docs or []:
+        try:
+            get_engine().ingest(session, doc_file.name, doc_file.getvalue())
+        except EngineError as e:
+            st.error(str(e))
+            return
+
+
+def render_ingest_jobs(session):
+    jobs = session.ingest_jobs
+
+    for job in jobs:
+        detail = f" - {job.chunks_done} fragmentos" if job.chunks_done else ""
+        if job.status == DONE and job.timings:
+            timings = ", ".join(
+                f"{strategy} {seconds:.1f}s" for strategy, seconds in job.timings.items()
+            )
+            detail += f" ({timings})"
+        if job.error:
+            detail = f" - {job.error}"
+        st.caption(
+            f"{INGEST_STATUS_ICONS[job.status]} {job.filename}: {job.status}{detail}"
+        )
+
+    # La ingesta espera detras del chat cuando la key llega a su limite
+    limits = get_scheduler(session.api_key).stats()
+    if limits["queued"]["bulk"]:
+        st.caption(
+            f"🚦 Limite de la API key: {limits['queued']['bulk']} lotes en espera "
+            f"(espera maxima {limits['wait_max_s']['bulk']:.1f}s)"
+        )
+
+    finished = [job for job in jobs if not job.is_active and not job.notified]
+    for job in finished:
+        job.notified = True
+        if job.status == DONE:
+            st.toast(f"Documento {job.filename} cargado", icon="✅")
+        else:
+            st.toast(
+                f"Error al procesar el documento {job.filename}: {job.error}",
+                icon="🚨",
+            )
+
+    # Rerun completo para actualizar el toggle de RAG y la lista de documentos,
+    # tambien cuando el primer lote hace consultable la coleccion
+    if finished or session.is_rag_ready != st.session_state.get("rag_ready_rendered"):
+        st.rerun()
+
+
+def open_conversation(conversation_id):
+    st.session_state.conversation_id = conversation_id
+    st.query_params["conversation"] = conversation_id
+    # se recarga la ventana reciente desde el historial guardado
+    st.session_state.pop("messages", None)
+
+
+def load_older_messages():
+    older = load_messages(
+        st.session_state.conversation_id,
+        before_id=st.session_state.messages[0]["id"],
+    )
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.history_window += len(older)
+    st.session_state.has_older_messages = len(older) == HISTORY_PAGE_SIZE
+
+
+def refresh_messages():
+    """Carga desde el historial solo la ventana reciente de la conversacion."""
+    messages = load_messages(
+        st.session_state.conversation_id, limit=st.session_state.history_window
+    )
+    st.session_state.messages = messages
+    st.session_state.has_older_messages = len(
+        messages
+    ) == st.session_state.history_window and has_older_messages(
+        st.session_state.conversation_id, messages[0]["id"]
+    )
 
-# import rag functions
-from rag import load_doc_to_db
-from tools import calculate, search
 
 st.set_page_config(page_title="DocuChat", page_icon="📄")
 
@@ -29,8 +120,12 @@ st.divider()
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid4())
 
-if "rag_sources" not in st.session_state:
-    st.session_state.rag_sources = []
+# La conversacion va en la URL para poder retomarla despues de reiniciar
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = st.query_params.get(
+        "conversation", str(uuid4())
+    )
+    st.query_params["conversation"] = st.session_state.conversation_id
 
 with st.sidebar:
     gemini_api_key = st.text_input(
@@ -42,49 +137,29 @@ with st.sidebar:
 if not gemini_api_key:
     st.error("Por favor, ingresa tu API Key de Gemini")
 else:
-    st.session_state.gemini_api_key = gemini_api_key
-
-    model = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=1.0,  # Gemini 3.0+ defaults to 1.0
-        max_tokens=None,
-        timeout=None,
-        max_retries=2,
-        api_key=gemini_api_key,
-    )
-
-    current_date = datetime.now().strftime("%d de %B de %Y")
+    try:
+        session = get_engine().get_session(st.session_state.session_id, gemini_api_key)
+    except NotFoundError:
+        # la sesion es de la API key anterior, con otra key se empieza una nueva
+        st.session_state.session_id = str(uuid4())
+        session = get_engine().get_session(st.session_state.session_id, gemini_api_key)
 
-    agent = create_agent(
-        model,
-        tools=[search, calculate],
-        system_prompt=f"""Eres DocuChat, un asistente inteligente que ayuda a los usuarios.
-
-        INFORMACIÓN TEMPORAL IMPORTANTE:
-        - Fecha actual: {current_date}
-
-        Tienes acceso a las siguientes herramientas:
-        1. search: Para buscar información actualizada en internet
-        2. calculate: Para realizar cálculos matemáticos
-
-        INSTRUCCIONES IMPORTANTES:
-        - Cuando uses la herramienta de búsqueda, los resultados son ACTUALES y corresponden a {current_date}
-        - Responde de manera clara y útil usando Markdown cuando sea apropiado
-        - Si no estás seguro de algo, usa la herramienta de búsqueda para verificar""",
-    )
+    # Una conversacion de la URL que es de otra API key no se abre
+    if not is_conversation_owner(st.session_state.conversation_id, session.owner):
+        open_conversation(str(uuid4()))
 
     with st.sidebar:
         uploaded_files = st.file_uploader(
             "Sube un documento",
             accept_multiple_files=True,
             type=("txt", "md", "pdf", "docx"),
-            on_change=load_doc_to_db(),
+            on_change=ingest_uploads,
+            args=(session,),
             key="rag_docs",
         )
 
-        is_vector_db_loaded = (
-            "vector_db" in st.session_state and st.session_state.vector_db is not None
-        )
+        is_vector_db_loaded = session.is_rag_ready
+        st.session_state.rag_ready_rendered = is_vector_db_loaded
         st.toggle(
             "Use RAG",
             value=is_vector_db_loaded,
@@ -93,21 +168,57 @@ else:
         )
 
         with st.expander(
-            f"Documentos en la BD ({0 if not is_vector_db_loaded else len(st.session_state.rag_sources)})"
+            f"Documentos en la BD ({0 if not is_vector_db_loaded else len(session.rag_sources)})"
         ):
             st.write(
                 []
                 if not is_vector_db_loaded
-                else [source for source in st.session_state.rag_sources]
+                else [source for source in session.rag_sources]
             )
 
+        # Mientras haya trabajos en la cola el fragmento se refresca solo
+        st.fragment(
+            render_ingest_jobs,
+            run_every=1 if any(job.is_active for job in session.ingest_jobs) else None,
+        )(session)
+
+        budget = budget_status(session.session_id)
+        st.caption(
+            f"Tokens usados en la sesión: {session_tokens(session.session_id):,} "
+            f"(documentos: {session_tokens(session.session_id, ingest=True):,})"
+        )
+        if budget == BUDGET_SOFT:
+            st.warning("Sesión cerca de su límite de tokens, se usa menos contexto")
+        elif budget == BUDGET_HARD:
+            st.error("La sesión alcanzó su límite de tokens")
+
+        with st.expander("Conversaciones"):
+            st.button(
+                "Nueva conversación",
+                on_click=open_conversation,
+                args=(str(uuid4()),),
+            )
+            for conversation in list_conversations(session.owner):
+                st.button(
+                    conversation["title"],
+                    key=f"conversation_{conversation['id']}",
+                    on_click=open_conversation,
+                    args=(conversation["id"],),
+                    disabled=conversation["id"] == st.session_state.conversation_id,
+                )
+
     if "messages" not in st.session_state:
-        st.session_state.messages = [
-            {
-                "role": "assistant",
-                "content": "Hola, soy DocuChat ¿Que consulta tienes el dia de hoy? Recuerda que puesdes subir documentos en la barra lateral.",
-            }
-        ]
+        st.session_state.history_window = HISTORY_PAGE_SIZE
+        refresh_messages()
+
+    if st.session_state.has_older_messages:
+        st.button("Cargar mensajes anteriores", on_click=load_older_messages)
+
+    if not st.session_state.messages:
+        with st.chat_message("assistant"):
+            st.markdown(
+                "Hola, soy DocuChat ¿Que consulta tienes el dia de hoy? Recuerda que puesdes subir documentos en la barra lateral."
+            )
 
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
@@ -120,18 +231,20 @@ else:
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            # changing format to langchain format
-            messages = [
-                HumanMessage(content=m["content"])
-                if m["role"] == "user"
-                else AIMessage(content=m["content"])
-                for m in st.session_state.messages
-            ]
-
             try:
-                if not st.session_state.use_rag:
-                    st.write_stream(llm_stream(agent, messages))
-                else:
-                    st.write_stream(stream_llm_rag_response(model, messages))
+                st.write_stream(
+                    get_engine().stream_chat(
+                        session,
+                        st.session_state.conversation_id,
+                        prompt,
+                        use_rag=st.session_state.use_rag,
+                        on_tool_call=lambda name: st.toast(
+                            f"Usando herramienta: {name}"
+                        ),
+                    )
+                )
             except Exception as e:
                 st.error(f"Error: {e}")
+
+        # El engine guarda el turno, solo se recarga la ventana reciente
+        refresh_messages()
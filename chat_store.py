@@ -0,0 +1,203 @@
+import os
+import sqlite3
+from contextlib import closing
+from time import time
+
+CHAT_DB_PATH = os.environ.get("DOCUCHAT_DB_PATH", "docuchat.db")
+HISTORY_PAGE_SIZE = 20
+
+
+class NotOwnerError(ValueError):
+    """La conversacion es de otra API key."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    owner TEXT,
+    title TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL REFERENCES conversations(id),
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation
+    ON messages (conversation_id, id);
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS session_sources (
+    session_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (session_id, filename)
+);
+"""
+
+
+def _connect():
+    # Una conexion por llamada: Streamlit ejecuta cada rerun en un hilo distinto
+    conn = sqlite3.connect(CHAT_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+
+    # bases creadas antes de que las conversaciones tuvieran dueño
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(conversations)")}
+    if "owner" not in columns:
+        try:
+            conn.execute("ALTER TABLE conversations ADD COLUMN owner TEXT")
+        except sqlite3.OperationalError:
+            pass  # otro proceso la agrego primero
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS conversations_by_owner"
+        " ON conversations (owner, updated_at)"
+    )
+    return conn
+
+
+def add_message(conversation_id, role, content, owner):
+    """Guarda un mensaje, creando la conversacion con el primero como titulo.
+
+    NotOwnerError si la conversacion es de otro `owner`, sin guardar nada.
+    """
+    now = time()
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT INTO conversations (id, owner, title, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at"
+            " WHERE conversations.owner = excluded.owner",
+            (conversation_id, owner, content[:60], now, now),
+        )
+        # en la misma transaccion, el upsert no actualiza una conversacion ajena
+        row = conn.execute(
+            "SELECT owner FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row["owner"] != owner:
+            raise NotOwnerError(conversation_id)
+
+        cursor = conn.execute(
+            "INSERT INTO messages (conversation_id, role, content, created_at)"
+            " VALUES (?, ?, ?, ?)",
+            (conversation_id, role, content, now),
+        )
+        return cursor.lastrowid
+
+
+def load_messages(conversation_id, limit=HISTORY_PAGE_SIZE, before_id=None):
+    """Los `limit` mensajes mas recientes (anteriores a `before_id`), en orden."""
+    query = "SELECT id, role, content FROM messages WHERE conversation_id = ?"
+    params = [conversation_id]
+    if before_id is not None:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    with closing(_connect()) as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    return [dict(row) for row in reversed(rows)]
+
+
+def has_older_messages(conversation_id, before_id):
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT 1 FROM messages WHERE conversation_id = ? AND id < ? LIMIT 1",
+            (conversation_id, before_id),
+        ).fetchone()
+
+    return row is not None
+
+
+def is_conversation_owner(conversation_id, owner):
+    """True si la conversacion es de `owner` o todavia no existe."""
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT owner FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+
+    # las conversaciones sin dueño (bases anteriores) no son de nadie
+    return row is None or (row["owner"] is not None and row["owner"] == owner)
+
+
+def list_conversations(owner, limit=HISTORY_PAGE_SIZE):
+    """Conversaciones recientes de `owner`, la ultima actualizada primero."""
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            "SELECT id, title, updated_at FROM conversations WHERE owner = ?"
+            " ORDER BY updated_at DESC LIMIT ?",
+            (owner, limit),
+        ).fetchall()
+
+    return [dict(row) for row in rows]
+
+
+def claim_session(session_id, owner):
+    """Registra el uso de la sesion; False si la creo otra API key."""
+    now = time()
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT INTO sessions (id, owner, created_at, last_used_at)"
+            " VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET last_used_at = excluded.last_used_at"
+            " WHERE sessions.owner = excluded.owner",
+            (session_id, owner, now, now),
+        )
+        row = conn.execute(
+            "SELECT owner FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+
+    return row["owner"] == owner
+
+
+def is_session_owner(session_id, owner):
+    """True si la sesion es de `owner` o todavia no existe."""
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT owner FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+
+    return row is None or row["owner"] == owner
+
+
+def session_last_used(session_id):
+    """Ultimo uso de la sesion en cualquier proceso, None si no existe."""
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT last_used_at FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+
+    return row["last_used_at"] if row else None
+
+
+def delete_session(session_id):
+    with closing(_connect()) as conn, conn:
+        conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        conn.execute("DELETE FROM session_sources WHERE session_id = ?", (session_id,))
+
+
+def add_session_source(session_id, filename):
+    """Registra un documento que termino de cargarse en la coleccion de la sesion."""
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO session_sources (session_id, filename) VALUES (?, ?)",
+            (session_id, filename),
+        )
+
+
+def load_session_sources(session_id):
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            "SELECT filename FROM session_sources WHERE session_id = ?"
+            " ORDER BY filename",
+            (session_id,),
+        ).fetchall()
+
+    return [row["filename"] for row in rows]
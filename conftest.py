@@ -2,4 +2,14 @@ import sys
 from pathlib import Path
 
 root_dir = Path(__file__).parent
-sys.path.insert(0, str(root_dir))
\ No newline at end of file
+sys.path.insert(0, str(root_dir))
+
+import pytest
+
+import chat_store
+
+
+@pytest.fixture(autouse=True)
+def chat_db(tmp_path, monkeypatch):
+    # Cada test usa su propia base, nunca la docuchat.db del repo
+    monkeypatch.setattr(chat_store, "CHAT_DB_PATH", str(tmp_path / "chat.db"))
@@ -0,0 +1,346 @@
+import hashlib
+import os
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from time import monotonic, time
+
+from langchain.agents import create_agent
+from langchain.messages import AIMessage, HumanMessage
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from agent import llm_stream, stream_llm_rag_response
+from chat_store import (
+    NotOwnerError,
+    add_message,
+    claim_session,
+    delete_session,
+    is_session_owner,
+    load_messages,
+    load_session_sources,
+    session_last_used,
+)
+from ingest import CANCELLED, DONE, FAILED, IngestJob, submit_job
+from rag import (
+    CHROMA_HOST,
+    CHROMA_PERSIST_DIR,
+    MAX_HISTORY_MESSAGES,
+    RETRIEVER_K,
+    ingest_file,
+    initialize_vector_db,
+)
+from ratelimit import SchedulerRateLimiter, UsageSettler, get_scheduler
+from tools import calculate, search
+from usage import (
+    BUDGET_HARD,
+    BUDGET_SOFT,
+    UsageRecorder,
+    budget_status,
+    ingest_budget_status,
+)
+
+MAX_SESSION_DOCS = 10
+# Con el presupuesto blando de tokens superado se responde con menos contexto
+DEGRADED_HISTORY_MESSAGES = 4
+DEGRADED_RETRIEVER_K = 2
+# Las sesiones sin uso (en ningun proceso) se cierran y se borra su coleccion,
+# la app de Streamlit nunca las cierra. 0 las mantiene para siempre
+SESSION_IDLE_SECONDS = int(os.environ.get("DOCUCHAT_SESSION_IDLE_SECONDS", 3600))
+# cada cuanto se buscan sesiones inactivas
+SESSION_EVICT_INTERVAL = 60
+# Para apuntar a otro endpoint compatible con la API de Gemini (p.ej. loadtest.py)
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
+
+class EngineError(ValueError):
+    """Error de uso que se le muestra tal cual al usuario."""
+
+
+class NotFoundError(EngineError):
+    """Sesion o conversacion inexistente o de otra API key."""
+
+
+def key_owner(api_key):
+    # El historial es de quien tiene la API key, sin guardar la key
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+@dataclass
+class Session:
+    session_id: str
+    api_key: str
+    vector_db: object = None
+    rag_sources: list = field(default_factory=list)
+    ingest_jobs: list = field(default_factory=list)
+    last_used_at: float = field(default_factory=time)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # la sesion es de la API key que la creo
+    owner: str = field(init=False)
+
+    def __post_init__(self):
+        self.owner = key_owner(self.api_key)
+
+    @property
+    def is_rag_ready(self):
+        # La coleccion es consultable apenas el primer lote de chunks fue agregado
+        return self.vector_db is not None and bool(
+            self.rag_sources or any(job.chunks_done for job in self.ingest_jobs)
+        )
+
+
+def build_model(api_key, base_url=None):
+    # espera en la cola de la key en lugar de fallar con 429 y reintentar
+    scheduler = get_scheduler(api_key)
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",
+        temperature=1.0,  # Gemini 3.0+ defaults to 1.0
+        max_tokens=None,
+        timeout=None,
+        max_retries=2,
+        api_key=api_key,
+        base_url=base_url,
+        rate_limiter=SchedulerRateLimiter(scheduler),
+        callbacks=[UsageSettler(scheduler)],
+    )
+
+
+def build_agent(model, current_date):
+    return create_agent(
+        model,
+        tools=[search, calculate],
+        system_prompt=f"""Eres DocuChat, un asistente inteligente que ayuda a los usuarios.
+
+        INFORMACIÓN TEMPORAL IMPORTANTE:
+        - Fecha actual: {current_date}
+
+        Tienes acceso a las siguientes herramientas:
+        1. search: Para buscar información actualizada en internet
+        2. calculate: Para realizar cálculos matemáticos
+
+        INSTRUCCIONES IMPORTANTES:
+        - Cuando uses la herramienta de búsqueda, los resultados son ACTUALES y corresponden a {current_date}
+        - Responde de manera clara y útil usando Markdown cuando sea apropiado
+        - Si no estás seguro de algo, usa la herramienta de búsqueda para verificar""",
+    )
+
+
+class Engine:
+    """Sesiones, ingesta y respuestas de DocuChat, sin depender de Streamlit.
+
+    La usan tanto la UI de Streamlit como el servidor HTTP (server.py).
+    """
+
+    def __init__(self, base_url=GEMINI_BASE_URL):
+        self.base_url = base_url
+        self._sessions = {}
+        self._models = {}
+        self._lock = threading.Lock()
+        self._evicted_at = monotonic()
+
+    def get_session(self, session_id, api_key):
+        """La sesion de `api_key`; NotFoundError si la creo otra key."""
+        owner = key_owner(api_key)
+        # el registro en la base vale para todos los procesos del servidor
+        if not claim_session(session_id, owner):
+            raise NotFoundError("Sesión no encontrada")
+
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and session.owner != owner:
+                raise NotFoundError("Sesión no encontrada")
+
+            is_new = session is None
+            if is_new:
+                session = Session(session_id=session_id, api_key=api_key)
+                self._sessions[session_id] = session
+            session.last_used_at = time()
+
+        if CHROMA_PERSIST_DIR or CHROMA_HOST:
+            # con varios procesos, otro pudo agregar documentos despues de cachear la sesion
+            if is_new or CHROMA_HOST:
+                self.refresh_sources(session)
+
+            # La coleccion persistida se reabre solo si la sesion tiene documentos,
+            # si no se crea con el primer archivo (ver ingest)
+            with session.lock:
+                if session.rag_sources and session.vector_db is None:
+                    session.vector_db = initialize_vector_db(
+                        api_key, session_id, base_url=self.base_url
+                    )
+
+        if monotonic() - self._evicted_at > SESSION_EVICT_INTERVAL:
+            self._evicted_at = monotonic()
+            self.evict_idle_sessions()
+        return session
+
+    def refresh_sources(self, session):
+        """Actualiza los documentos de la sesion con los registrados en la base."""
+        stored = set(load_session_sources(session.session_id))
+
+        with session.lock:
+            # los que se estan cargando aqui aparecen al terminar su job
+            active = {job.filename for job in session.ingest_jobs if job.is_active}
+            done = {job.filename for job in session.ingest_jobs if job.status == DONE}
+            session.rag_sources[:] = sorted((stored | done) - active)
+
+    def evict_idle_sessions(self, max_idle=None):
+        """Cierra las sesiones sin uso hace mas de `max_idle` segundos."""
+        max_idle = SESSION_IDLE_SECONDS if max_idle is None else max_idle
+        if not max_idle:
+            return []
+
+        deadline = time() - max_idle
+        with self._lock:
+            idle = [
+                session.session_id
+                for session in self._sessions.values()
+                if session.last_used_at < deadline
+                and not any(job.is_active for job in session.ingest_jobs)
+            ]
+
+        evicted = []
+        for session_id in idle:
+            # otro proceso pudo seguir usandola
+            last_used_at = session_last_used(session_id)
+            if last_used_at is None or last_used_at < deadline:
+                self.close_session(session_id)
+                evicted.append(session_id)
+        return evicted
+
+    def session_ids(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def check_session_owner(self, session_id, api_key):
+        if not is_session_owner(session_id, key_owner(api_key)):
+            raise NotFoundError("Sesión no encontrada")
+
+    def close_session(self, session_id, api_key=None):
+        """Cierra la sesion y borra su coleccion; con `api_key`, solo si es suya."""
+        if api_key is not None:
+            self.check_session_owner(session_id, api_key)
+
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        delete_session(session_id)
+
+        if session is None:
+            return
+
+        # los trabajos pendientes no siguen ocupando la cola de ingesta
+        for job in session.ingest_jobs:
+            job.cancel()
+        if session.vector_db is not None:
+            session.vector_db.delete_collection()
+
+    def get_model(self, api_key):
+        """Modelo y agente por API key, el agente se rehace al cambiar la fecha."""
+        current_date = datetime.now().strftime("%d de %B de %Y")
+
+        with self._lock:
+            cached = self._models.get(api_key)
+            if cached is None or cached[2] != current_date:
+                model = build_model(api_key, self.base_url)
+                cached = (model, build_agent(model, current_date), current_date)
+                self._models[api_key] = cached
+
+        return cached[0], cached[1]
+
+    def ingest(self, session, filename, data):
+        """Encola un archivo para la sesion; None si ya estaba cargado o en la cola."""
+        filename = os.path.basename(filename)
+
+        if ingest_budget_status(session.session_id) == BUDGET_HARD:
+            raise EngineError("La sesión alcanzó su límite de tokens para documentos")
+
+        with session.lock:
+            pending = [job for job in session.ingest_jobs if job.is_active]
+            if len(session.rag_sources) + len(pending) >= MAX_SESSION_DOCS:
+                raise EngineError(
+                    "Solo se pueden cargar hasta 10 documentos, elimine alguno"
+                )
+
+            # un archivo que fallo se puede volver a subir, reemplaza al job fallido
+            known_files = set(session.rag_sources) | {
+                job.filename
+                for job in session.ingest_jobs
+                if job.status not in (FAILED, CANCELLED)
+            }
+            if filename in known_files:
+                return None
+            session.ingest_jobs[:] = [
+                job for job in session.ingest_jobs if job.filename != filename
+            ]
+
+            # La coleccion se crea vacia para que el worker pueda ir agregando lotes
+            if session.vector_db is None:
+                session.vector_db = initialize_vector_db(
+                    session.api_key, session.session_id, base_url=self.base_url
+                )
+
+            # unstructured necesita el file path con el nombre del archivo
+            job_folder = tempfile.mkdtemp(prefix=f"source_files_{session.session_id}_")
+            file_path = os.path.join(job_folder, filename)
+            with open(file_path, "wb") as file:
+                file.write(data)
+
+            job = IngestJob(
+                session_id=session.session_id,
+                filename=filename,
+                file_path=file_path,
+            )
+            session.ingest_jobs.append(job)
+
+        submit_job(job, ingest_file, session.vector_db, session.rag_sources)
+        return job
+
+    def stream_chat(
+        self, session, conversation_id, prompt, use_rag=False, on_tool_call=None
+    ):
+        """Guarda el mensaje y devuelve el stream de la respuesta.
+
+        La respuesta completa se guarda en el historial cuando el stream termina.
+        """
+        if use_rag and not session.is_rag_ready:
+            raise EngineError("No hay documentos cargados para usar RAG")
+
+        budget = budget_status(session.session_id)
+        if budget == BUDGET_HARD:
+            raise EngineError("La sesión alcanzó su límite de tokens")
+
+        history_messages, retriever_k = MAX_HISTORY_MESSAGES, RETRIEVER_K
+        if budget == BUDGET_SOFT:
+            history_messages, retriever_k = DEGRADED_HISTORY_MESSAGES, DEGRADED_RETRIEVER_K
+
+        try:
+            add_message(conversation_id, "user", prompt, session.owner)
+        except NotOwnerError:
+            raise NotFoundError("Conversación no encontrada")
+
+        # changing format to langchain format (solo el historial reciente)
+        messages = [
+            HumanMessage(content=m["content"])
+            if m["role"] == "user"
+            else AIMessage(content=m["content"])
+            for m in load_messages(conversation_id, limit=history_messages)
+        ]
+
+        model, agent = self.get_model(session.api_key)
+        callbacks = [UsageRecorder(session.session_id, model.model)]
+        if use_rag:
+            stream = stream_llm_rag_response(
+                model, messages, session.vector_db, retriever_k, callbacks=callbacks
+            )
+        else:
+            stream = llm_stream(agent, messages, on_tool_call, callbacks=callbacks)
+
+        return self._save_response(conversation_id, session.owner, stream)
+
+    def _save_response(self, conversation_id, owner, stream):
+        response_message = ""
+        for text in stream:
+            response_message += text
+            yield text
+
+        add_message(conversation_id, "assistant", response_message, owner)
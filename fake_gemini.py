@@ -0,0 +1,151 @@
+# Servidor local que imita la API de Gemini (generateContent,
+# streamGenerateContent y batchEmbedContents) con latencia configurable.
+# Lo usa loadtest.py para medir DocuChat sin gastar cuota real.
+import hashlib
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+from ratelimit import estimate_tokens
+
+
+def fake_embedding(text, dimensions):
+    # determinista por texto, para que el retrieval sea reproducible
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(dimensions)]
+
+
+def prompt_text(body):
+    """Texto del prompt, incluida la instruccion de sistema (el contexto del RAG)."""
+    system = body.get("systemInstruction") or {}
+    return "".join(
+        part.get("text", "")
+        for content in [system, *body.get("contents", [])]
+        for part in content.get("parts", [])
+    )
+
+
+class _FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+
+        with self.server.stats_lock:
+            self.server.requests += 1
+
+        if self.path.split("?")[0].endswith(":batchEmbedContents"):
+            sleep(server.embed_latency)
+            self._send_json(
+                {
+                    "embeddings": [
+                        {
+                            "values": fake_embedding(
+                                request["content"]["parts"][0]["text"],
+                                server.dimensions,
+                            )
+                        }
+                        for request in body["requests"]
+                    ]
+                }
+            )
+        elif ":streamGenerateContent" in self.path:
+            self._stream_generate(body)
+        elif self.path.endswith(":generateContent"):
+            sleep(server.ttft + server.token_delay * server.tokens)
+            self._send_json(self._response(body, server.tokens, finished=True))
+        else:
+            self._send_json({"error": {"code": 404, "message": self.path}}, 404)
+
+    def _response(self, body, tokens, generated=None, finished=False):
+        # en streaming Gemini informa el uso acumulado en cada chunk
+        generated = tokens if generated is None else generated
+        prompt_tokens = estimate_tokens(prompt_text(body))
+        response = {
+            "candidates": [
+                {
+                    "content": {
+                        "role": "model",
+                        "parts": [{"text": "palabra " * tokens}],
+                    },
+                    "index": 0,
+                }
+            ],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": generated,
+                "totalTokenCount": prompt_tokens + generated,
+            },
+        }
+        if finished:
+            response["candidates"][0]["finishReason"] = "STOP"
+        return response
+
+    def _stream_generate(self, body):
+        server = self.server
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        sleep(server.ttft)
+        for i in range(server.tokens):
+            if i:
+                sleep(server.token_delay)
+            response = self._response(
+                body, 1, generated=i + 1, finished=i == server.tokens - 1
+            )
+            self.wfile.write(b"data: " + json.dumps(response).encode() + b"\r\n\r\n")
+            self.wfile.flush()
+        self.close_connection = True
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        ttft=0.3,
+        token_delay=0.02,
+        tokens=60,
+        embed_latency=0.05,
+        dimensions=64,
+        host="127.0.0.1",
+        port=0,
+    ):
+        super().__init__((host, port), _FakeGeminiHandler)
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.embed_latency = embed_latency
+        self.dimensions = dimensions
+        self.requests = 0
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
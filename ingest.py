@@ -0,0 +1,218 @@
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from functools import partial
+from time import time
+from uuid import uuid4
+
+INGEST_WORKERS = 2
+# Trabajos de una misma sesion procesandose a la vez, el resto espera su turno
+MAX_SESSION_RUNNING = 1
+PIPELINE_QUEUE_SIZE = 2
+
+# Estados de un trabajo de ingesta (se muestran en la barra lateral)
+QUEUED = "en cola"
+RUNNING = "procesando"
+DONE = "listo"
+FAILED = "error"
+CANCELLED = "cancelado"
+
+
+class JobCancelled(Exception):
+    """El trabajo se cancelo, p.ej. porque se cerro su sesion."""
+
+
+@dataclass
+class IngestJob:
+    session_id: str
+    filename: str
+    file_path: str
+    job_id: str = field(default_factory=lambda: str(uuid4()))
+    status: str = QUEUED
+    chunks_done: int = 0
+    error: str | None = None
+    timings: dict = field(default_factory=dict)  # segundos por estrategia
+    submitted_at: float = field(default_factory=time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    notified: bool = False  # la UI ya aviso que termino
+    cancelled: bool = False
+
+    @property
+    def is_active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    def cancel(self):
+        # el trabajo en cola no se ejecuta, el que esta corriendo para en el proximo lote
+        self.cancelled = True
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+
+def _run_job(job, fn, args):
+    if job.cancelled:
+        job.status = CANCELLED
+        job.finished_at = time()
+        return
+
+    job.status = RUNNING
+    job.started_at = time()
+    try:
+        fn(job, *args)
+        job.status = DONE
+    except JobCancelled:
+        job.status = CANCELLED
+    except Exception as e:
+        job.error = str(e)
+        job.status = FAILED
+    finally:
+        job.finished_at = time()
+
+
+class _FairQueue:
+    """Cola de ingesta compartida por todo el proceso.
+
+    Los workers atienden a las sesiones por turnos, con a lo sumo
+    MAX_SESSION_RUNNING trabajos de cada una a la vez: los archivos grandes de
+    un usuario no demoran las subidas de los demas.
+    """
+
+    def __init__(self, workers):
+        self._workers = workers
+        self._threads = []
+        self._cond = threading.Condition()
+        self._pending = {}  # session_id -> deque de trabajos, en orden de turno
+        self._running = Counter()
+
+    def submit(self, job, fn, args):
+        future = Future()
+        with self._cond:
+            self._pending.setdefault(job.session_id, deque()).append(
+                (job, fn, args, future)
+            )
+            while len(self._threads) < self._workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f"ingest-{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+        return future
+
+    def _next(self):
+        with self._cond:
+            while True:
+                for session_id, items in self._pending.items():
+                    if self._running[session_id] < MAX_SESSION_RUNNING:
+                        item = items.popleft()
+                        # la sesion pasa al final de la ronda
+                        del self._pending[session_id]
+                        if items:
+                            self._pending[session_id] = items
+                        self._running[session_id] += 1
+                        return item
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            job, fn, args, future = self._next()
+            try:
+                _run_job(job, fn, args)
+                future.set_result(None)
+            finally:
+                with self._cond:
+                    self._running[job.session_id] -= 1
+                    if not self._running[job.session_id]:
+                        del self._running[job.session_id]
+                    self._cond.notify_all()
+
+
+# Los trabajos no bloquean el script de Streamlit ni las requests del servidor
+_queue = _FairQueue(INGEST_WORKERS)
+
+
+def submit_job(job, fn, *args):
+    """Encola `fn(job, *args)` en el worker de ingesta y devuelve el Future."""
+    return _queue.submit(job, fn, args)
+
+
+# Marcadores que viajan por las colas del pipeline
+_END = object()
+
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(in_queue, stop):
+    while not stop.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        if isinstance(item, _StageError):
+            raise item.error
+        yield item
+
+
+def _pump(make_items, out_queue, stop):
+    try:
+        for item in make_items():
+            if not _put(out_queue, item, stop):
+                return
+        end = _END
+    except Exception as e:
+        end = _StageError(e)
+    _put(out_queue, end, stop)
+
+
+def _run_stage(stage, in_queue, stop):
+    return stage(_drain(in_queue, stop))
+
+
+def pipeline(source, *stages, maxsize=PIPELINE_QUEUE_SIZE):
+    """Encadena `source` y cada `stage` (iterable -> iterable) en hilos propios.
+
+    Las etapas se comunican por colas acotadas a `maxsize` elementos, asi cada
+    una avanza en paralelo con las demas sin acumular todo en memoria. La
+    salida de la ultima etapa se entrega en el hilo que itera; un error en
+    cualquier etapa se relanza aqui, y si se deja de iterar las etapas paran.
+    """
+    stop = threading.Event()
+    out_queue = queue.Queue(maxsize=maxsize)
+    threading.Thread(
+        target=_pump, args=(lambda: source, out_queue, stop), daemon=True
+    ).start()
+
+    for stage in stages:
+        in_queue, out_queue = out_queue, queue.Queue(maxsize=maxsize)
+        # la etapa se construye dentro de su hilo, por si no es un generador
+        threading.Thread(
+            target=_pump,
+            args=(partial(_run_stage, stage, in_queue, stop), out_queue, stop),
+            daemon=True,
+        ).start()
+
+    try:
+        yield from _drain(out_queue, stop)
+    finally:
+        stop.set()
@@ -0,0 +1,424 @@
+# Prueba de carga y soak de DocuChat contra un Gemini falso local.
+#
+#   python loadtest.py --sessions 20 --duration 3600 --json-out soak.jsonl
+#
+# Cada sesion simulada sube documentos (Engine.ingest, el mismo camino que
+# load_doc_to_db) y conversa en modo agente o RAG (llm_stream,
+# stream_llm_rag_response) hasta cumplir sus turnos, cierra la sesion y abre
+# otra. Cada --report-every segundos se informa throughput, latencia hasta el
+# primer token, crecimiento de la memoria del proceso (por sesion cerrada y por
+# hora) y colecciones que quedaron sin sesion.
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from time import monotonic, sleep, time
+from uuid import uuid4
+
+import chromadb
+import psutil
+
+import chat_store
+import ratelimit
+import usage
+from engine import Engine
+from fake_gemini import FakeGeminiServer
+from ingest import DONE
+from rag import CHROMA_HOST, CHROMA_PERSIST_DIR, CHROMA_PORT, chroma_client_lock
+
+# Como en la app, cada usuario simulado usa su propia API key y su propia cuota
+API_KEY_PREFIX = "fake-api-key-"
+
+# Muestras guardadas para los percentiles del total, acotado para soaks largos
+RESERVOIR_SIZE = 100_000
+
+WORDS = (
+    "documento contrato informe cliente pago plazo proyecto entrega riesgo "
+    "presupuesto analisis resultado objetivo equipo calidad servicio norma"
+).split()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+@dataclass
+class Window:
+    """Contadores de un intervalo de reporte (o del total de la corrida)."""
+
+    turns: int = 0
+    turn_errors: int = 0
+    uploads: int = 0
+    upload_errors: int = 0
+    chunks: int = 0
+    sessions: int = 0  # sesiones simuladas que terminaron y se cerraron
+    ttft: list = field(default_factory=list)
+    turn_latency: list = field(default_factory=list)
+    samples: int = 0
+
+    def add_sample(self, name, value, rng, limit=None):
+        values = getattr(self, name)
+        if limit is None or len(values) < limit:
+            values.append(value)
+            return
+        # reservoir sampling: cada muestra tiene la misma probabilidad de quedar
+        index = rng.randrange(self.samples)
+        if index < limit:
+            values[index] = value
+
+
+class LoadStats:
+    def __init__(self, seed=None):
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.interval = Window()
+        self.total = Window()
+
+    def record_turn(self, ttft, latency, error=False):
+        with self._lock:
+            for window, limit in ((self.interval, None), (self.total, RESERVOIR_SIZE)):
+                if error:
+                    window.turn_errors += 1
+                    continue
+                window.turns += 1
+                window.samples += 1
+                window.add_sample("ttft", ttft, self._rng, limit)
+                window.add_sample("turn_latency", latency, self._rng, limit)
+
+    def record_upload(self, error=False):
+        with self._lock:
+            for window in (self.interval, self.total):
+                if error:
+                    window.upload_errors += 1
+                else:
+                    window.uploads += 1
+
+    def record_chunks(self, chunks):
+        with self._lock:
+            self.interval.chunks += chunks
+            self.total.chunks += chunks
+
+    def record_session(self):
+        with self._lock:
+            self.interval.sessions += 1
+            self.total.sessions += 1
+
+    def take_interval(self):
+        with self._lock:
+            interval, self.interval = self.interval, Window()
+        return interval
+
+
+def make_document(rng, paragraphs):
+    """Markdown sintetico con titulos y parrafos de largo variable."""
+    lines = []
+    for i in range(paragraphs):
+        if i % 10 == 0:
+            lines.append(f"## Seccion {i // 10 + 1}\n")
+        words = rng.choices(WORDS, k=rng.randint(30, 120))
+        lines.append(" ".join(words).capitalize() + ".\n")
+    return f"doc_{uuid4().hex[:8]}.md", "\n".join(lines).encode()
+
+
+def session_collections():
+    """Nombres de las colecciones de sesion que existen en Chroma."""
+    with chroma_client_lock:
+        if CHROMA_HOST:
+            client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        elif CHROMA_PERSIST_DIR:
+            client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+        else:
+            client = chromadb.EphemeralClient()
+    return [
+        collection.name
+        for collection in client.list_collections()
+        if collection.name.startswith("session_")
+    ]
+
+
+def wait_for_jobs(session, timeout):
+    deadline = monotonic() + timeout
+    while any(job.is_active for job in session.ingest_jobs) and monotonic() < deadline:
+        sleep(0.1)
+
+
+def run_user(engine, stats, args, deadline, rng, api_key):
+    """Una sesion simulada tras otra hasta que se acabe el tiempo."""
+    while monotonic() < deadline:
+        session = engine.get_session(str(uuid4()), api_key)
+        conversation_id = str(uuid4())
+
+        for _ in range(args.turns_per_session):
+            if monotonic() >= deadline:
+                break
+
+            if rng.random() < args.upload_prob:
+                filename, data = make_document(rng, args.doc_paragraphs)
+                # se cuenta como subida recien cuando el job termina bien
+                try:
+                    engine.ingest(session, filename, data)
+                except Exception:
+                    stats.record_upload(error=True)
+            else:
+                use_rag = session.is_rag_ready and rng.random() < args.rag_prob
+                prompt = " ".join(rng.choices(WORDS, k=rng.randint(5, 25))) + "?"
+                started_at = monotonic()
+                ttft = None
+                try:
+                    for _ in engine.stream_chat(
+                        session, conversation_id, prompt, use_rag=use_rag
+                    ):
+                        if ttft is None:
+                            ttft = monotonic() - started_at
+                    stats.record_turn(ttft or 0.0, monotonic() - started_at)
+                except Exception:
+                    stats.record_turn(None, None, error=True)
+
+            sleep(rng.uniform(0, 2 * args.think_time))
+
+        wait_for_jobs(session, args.job_timeout)
+        # los fallidos y los que no terminaron a tiempo son errores
+        for job in session.ingest_jobs:
+            stats.record_upload(error=job.status != DONE)
+        stats.record_chunks(sum(job.chunks_done for job in session.ingest_jobs))
+        engine.close_session(session.session_id)
+        stats.record_session()
+
+
+def limiter_stats(api_keys):
+    """Cola y esperas del rate limiter sumadas sobre las keys de los usuarios."""
+    limits = {
+        "queued": {"interactive": 0, "bulk": 0},
+        "granted": {"interactive": 0, "bulk": 0},
+        "wait_max_s": {"interactive": 0.0, "bulk": 0.0},
+    }
+    for api_key in api_keys:
+        stats = ratelimit.get_scheduler(api_key).stats()
+        for priority in ("interactive", "bulk"):
+            limits["queued"][priority] += stats["queued"][priority]
+            limits["granted"][priority] += stats["granted"][priority]
+            limits["wait_max_s"][priority] = max(
+                limits["wait_max_s"][priority], stats["wait_max_s"][priority]
+            )
+    return limits
+
+
+def report(
+    engine, process, started_at, interval, elapsed_interval, api_keys, rss_start, sessions
+):
+    """Una fila del reporte; `sessions` son las sesiones cerradas desde el inicio."""
+    active = engine.session_ids()
+    collections = session_collections()
+    rss = process.memory_info().rss
+    limits = limiter_stats(api_keys)
+    elapsed = monotonic() - started_at
+    # el RSS total no se reparte entre sesiones, lo que importa es cuanto crece
+    growth_mb = (rss - rss_start) / 2**20
+
+    return {
+        "time": time(),
+        "elapsed_s": round(elapsed, 1),
+        "active_sessions": len(active),
+        "turns_per_s": round(interval.turns / elapsed_interval, 2),
+        "uploads": interval.uploads,
+        "chunks": interval.chunks,
+        "turn_errors": interval.turn_errors,
+        "upload_errors": interval.upload_errors,
+        "ttft_p50_s": percentile(interval.ttft, 50),
+        "ttft_p95_s": percentile(interval.ttft, 95),
+        "ttft_p99_s": percentile(interval.ttft, 99),
+        "turn_p95_s": percentile(interval.turn_latency, 95),
+        "rss_mb": round(rss / 2**20, 1),
+        "rss_growth_mb": round(growth_mb, 1),
+        "rss_growth_per_session_mb": round(growth_mb / sessions, 3)
+        if sessions
+        else None,
+        "rss_growth_per_hour_mb": round(growth_mb * 3600 / elapsed, 1)
+        if elapsed > 0
+        else None,
+        "threads": threading.active_count(),
+        "queued_interactive": limits["queued"]["interactive"],
+        "queued_bulk": limits["queued"]["bulk"],
+        "wait_max_interactive_s": limits["wait_max_s"]["interactive"],
+        "wait_max_bulk_s": limits["wait_max_s"]["bulk"],
+        "collections": len(collections),
+        # colecciones sin una sesion abierta que las use
+        "leaked_collections": len(
+            set(collections) - {f"session_{session_id}" for session_id in active}
+        ),
+    }
+
+
+def format_report(row):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    def mb(value):
+        return "-" if value is None else f"{value}MB"
+
+    return (
+        f"[{row['elapsed_s']:>7}s] sesiones={row['active_sessions']} "
+        f"turnos/s={row['turns_per_s']} subidas={row['uploads']} "
+        f"chunks={row['chunks']} errores={row['turn_errors']}/{row['upload_errors']} "
+        f"ttft p50={ms(row['ttft_p50_s'])} p95={ms(row['ttft_p95_s'])} "
+        f"p99={ms(row['ttft_p99_s'])} rss={row['rss_mb']}MB "
+        f"(+{row['rss_growth_mb']}MB, {mb(row['rss_growth_per_session_mb'])}"
+        f"/sesion cerrada, {mb(row['rss_growth_per_hour_mb'])}/h) "
+        f"hilos={row['threads']} "
+        f"cola={row['queued_interactive']}/{row['queued_bulk']} "
+        f"espera max={ms(row['wait_max_interactive_s'])}/{ms(row['wait_max_bulk_s'])} "
+        f"colecciones={row['collections']} huerfanas={row['leaked_collections']}"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Prueba de carga y soak de DocuChat contra un Gemini falso local"
+    )
+    parser.add_argument("--sessions", type=int, default=10, help="sesiones concurrentes")
+    parser.add_argument("--duration", type=float, default=60, help="segundos de prueba")
+    parser.add_argument("--report-every", type=float, default=10)
+    parser.add_argument("--turns-per-session", type=int, default=20)
+    parser.add_argument("--upload-prob", type=float, default=0.1)
+    parser.add_argument("--rag-prob", type=float, default=0.7)
+    parser.add_argument("--think-time", type=float, default=1.0, help="pausa media (s)")
+    parser.add_argument("--doc-paragraphs", type=int, default=200)
+    parser.add_argument("--job-timeout", type=float, default=60)
+    parser.add_argument("--ttft", type=float, default=0.3, help="latencia falsa (s)")
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    # sin limite por defecto, para medir el servidor y no la cuota de Gemini
+    parser.add_argument(
+        "--rpm", type=int, default=0, help="cuota por usuario simulado (0 sin limite)"
+    )
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--json-out", help="archivo JSONL con cada reporte")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+def run(args, out=print):
+    fake_gemini = FakeGeminiServer(
+        ttft=args.ttft,
+        token_delay=args.token_delay,
+        tokens=args.tokens,
+        embed_latency=args.embed_latency,
+    ).start()
+    ratelimit.REQUESTS_PER_MINUTE = args.rpm
+    ratelimit.TOKENS_PER_MINUTE = args.tpm
+
+    # el servidor falso corre en el mismo proceso, su memoria entra en el RSS
+    engine = Engine(base_url=fake_gemini.url)
+    stats = LoadStats(args.seed)
+    process = psutil.Process()
+    rss_start = process.memory_info().rss
+    rows = []
+
+    started_at = monotonic()
+    started_at_wall = time()
+    deadline = started_at + args.duration
+    seed_rng = random.Random(args.seed)
+    # keys nuevas en cada corrida, los schedulers viven lo que dura el proceso
+    api_keys = [f"{API_KEY_PREFIX}{uuid4().hex[:8]}" for _ in range(args.sessions)]
+    users = [
+        threading.Thread(
+            target=run_user,
+            args=(
+                engine,
+                stats,
+                args,
+                deadline,
+                random.Random(seed_rng.random()),
+                api_key,
+            ),
+            daemon=True,
+        )
+        for api_key in api_keys
+    ]
+    for user in users:
+        user.start()
+
+    json_out = open(args.json_out, "a") if args.json_out else None
+    try:
+        last_report = started_at
+        while any(user.is_alive() for user in users):
+            for user in users:
+                user.join(timeout=max(0, last_report + args.report_every - monotonic()))
+            now = monotonic()
+            if now - last_report >= args.report_every or not any(
+                user.is_alive() for user in users
+            ):
+                row = report(
+                    engine,
+                    process,
+                    started_at,
+                    stats.take_interval(),
+                    max(now - last_report, 1e-6),
+                    api_keys,
+                    rss_start,
+                    stats.total.sessions,
+                )
+                last_report = now
+                rows.append(row)
+                out(format_report(row))
+                if json_out:
+                    json_out.write(json.dumps(row) + "\n")
+                    json_out.flush()
+    finally:
+        if json_out:
+            json_out.close()
+        fake_gemini.stop()
+
+    total = stats.total
+    duration = monotonic() - started_at
+    summary = {
+        "duration_s": round(duration, 1),
+        "turns": total.turns,
+        "turns_per_s": round(total.turns / duration, 2),
+        "sessions": total.sessions,
+        "uploads": total.uploads,
+        "chunks": total.chunks,
+        "turn_errors": total.turn_errors,
+        "upload_errors": total.upload_errors,
+        "ttft_p50_s": percentile(total.ttft, 50),
+        "ttft_p95_s": percentile(total.ttft, 95),
+        "ttft_p99_s": percentile(total.ttft, 99),
+        "turn_p95_s": percentile(total.turn_latency, 95),
+        "rss_start_mb": round(rss_start / 2**20, 1),
+        "rss_end_mb": rows[-1]["rss_mb"] if rows else None,
+        "rss_growth_per_session_mb": rows[-1]["rss_growth_per_session_mb"]
+        if rows
+        else None,
+        "rss_growth_per_hour_mb": rows[-1]["rss_growth_per_hour_mb"] if rows else None,
+        "leaked_collections": rows[-1]["leaked_collections"] if rows else None,
+        "fake_gemini_requests": fake_gemini.requests,
+        "rate_limits": limiter_stats(api_keys),
+        # consumo por etapa de esta corrida, para extrapolar a mas usuarios
+        "usage_by_stage": usage.usage_totals(["stage"], since=started_at_wall),
+    }
+    out("Resumen: " + json.dumps(summary))
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # El historial de la prueba no se mezcla con el de la app
+    if "DOCUCHAT_DB_PATH" not in os.environ:
+        chat_store.CHAT_DB_PATH = os.path.join(
+            tempfile.mkdtemp(prefix="docuchat_loadtest_"), "chat.db"
+        )
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
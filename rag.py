@@ -1,8 +1,12 @@
 import os
 import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
 from time import time
 
-import streamlit as st
 from langchain_chroma.vectorstores import Chroma
 from langchain_classic.chains import (
     create_history_aware_retriever,
@@ -13,122 +17,268 @@ from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_google_genai.embeddings import GoogleGenerativeAIEmbeddings
 from langchain_google_genai.llms import GoogleGenerativeAI
+from pypdf import PdfReader, PdfWriter
 from unstructured.chunking.basic import chunk_elements
 from unstructured.cleaners.core import clean, replace_unicode_quotes
 from unstructured.partition.auto import partition
 
+from chat_store import add_session_source
+from ingest import pipeline
+from ratelimit import ScheduledEmbeddings, get_scheduler
+from usage import ANSWER, REWRITE, UsageEmbeddings
+
+CHROMA_PERSIST_DIR = os.environ.get("CHROMA_PERSIST_DIR")
+# Servidor de Chroma (`chroma run`), necesario para compartir colecciones entre
+# procesos: un PersistentClient no ve lo que escribe otro proceso
+CHROMA_HOST = os.environ.get("CHROMA_HOST")
+CHROMA_PORT = int(os.environ.get("CHROMA_PORT", 8000))
 MAX_HISTORY_MESSAGES = 10
 RETRIEVER_K = 5
 RELEVANCE_THRESHOLD = 0.7
+INGEST_BATCH_SIZE = 32
+# Menos caracteres que esto en una pagina se considera escaneada
+MIN_PAGE_TEXT_CHARS = 20
+OCR_STRATEGY = "hi_res"
+OCR_WORKERS = 4
+# Paginas que se particionan juntas antes de pasar al chunking
+PAGES_PER_RANGE = 20
+
+
+def chunk_to_doc(chunk, source, chunk_id):
+    metadata_dict = dict(chunk.metadata.to_dict())
+
+    clean_metadata = {
+        "source": source,
+        "chunk_id": chunk_id,
+        "page_number": metadata_dict.get("page_number", "None"),
+        "filetype": metadata_dict.get("filetype", "None"),
+        "filename": metadata_dict.get("filename", "None"),
+        # Convertir listas a strings si existen
+        "languages": ", ".join(metadata_dict.get("languages", []))
+        if metadata_dict.get("languages")
+        else None,
+    }
+
+    return Document(page_content=chunk.text, metadata=clean_metadata)
+
+
+def find_scanned_pages(file_path, first_page=1, last_page=None):
+    """Numeros de pagina (desde 1) del rango que no tienen capa de texto."""
+    reader = PdfReader(file_path)
+    last_page = last_page or len(reader.pages)
+    return [
+        page_number
+        for page_number in range(first_page, last_page + 1)
+        if len((reader.pages[page_number - 1].extract_text() or "").strip())
+        < MIN_PAGE_TEXT_CHARS
+    ]
+
+
+def partition_pdf_pages(file_path, first_page, last_page, strategy):
+    """Particiona solo un rango de paginas, escrito como PDF aparte."""
+    reader = PdfReader(file_path)
+    writer = PdfWriter()
+    for page_number in range(first_page, last_page + 1):
+        writer.add_page(reader.pages[page_number - 1])
+
+    with tempfile.TemporaryDirectory() as range_folder:
+        range_path = os.path.join(range_folder, f"pages_{first_page}_{last_page}.pdf")
+        with open(range_path, "wb") as file:
+            writer.write(file)
+
+        # starting_page_number mantiene la numeracion del documento original
+        return partition(
+            filename=range_path,
+            strategy=strategy,
+            starting_page_number=first_page,
+            metadata_filename=os.path.basename(file_path),
+        )
 
 
-def load_doc_to_db():
-    # Comprobar si se han subido documentos
-    if "rag_docs" not in st.session_state or not st.session_state.rag_docs:
-        st.error("No se subio ningun documento")
-        return
+def partition_pdf_range(file_path, first_page, last_page, timings=None):
+    """Particiona un rango de paginas eligiendo la estrategia por pagina.
 
-    docs = []
+    Las paginas con capa de texto se extraen con la estrategia "fast" y solo
+    las escaneadas pasan por OCR, en paralelo. `timings` acumula los segundos
+    usados por cada estrategia.
+    """
+    timings = {} if timings is None else timings
 
-    if len(st.session_state.rag_sources) >= 10:
-        st.error("Solo se pueden cargar hasta 10 documentos, elimine alguno")
-        return
+    def record(strategy, started_at):
+        timings[strategy] = timings.get(strategy, 0.0) + time() - started_at
+
+    started_at = time()
+    scanned_pages = find_scanned_pages(file_path, first_page, last_page)
+    record("detect", started_at)
+
+    elements = []
+    if len(scanned_pages) < last_page - first_page + 1:
+        started_at = time()
+        skip_pages = set(scanned_pages)
+        elements = [
+            element
+            for element in partition_pdf_pages(file_path, first_page, last_page, "fast")
+            if element.metadata.page_number not in skip_pages
+        ]
+        record("fast", started_at)
 
-    # Crear carpeta de sesión una sola vez
-    session_folder = f"source_files_{st.session_state['session_id']}"
-    os.makedirs(session_folder, exist_ok=True)
+    if scanned_pages:
+        started_at = time()
+        with ThreadPoolExecutor(max_workers=OCR_WORKERS) as pool:
+            for page_elements in pool.map(
+                lambda page_number: partition_pdf_pages(
+                    file_path, page_number, page_number, OCR_STRATEGY
+                ),
+                scanned_pages,
+            ):
+                elements.extend(page_elements)
+        record(OCR_STRATEGY, started_at)
 
-    for doc_file in st.session_state.rag_docs:
-        # Verificar si el documento ya ha sido cargado
-        if doc_file.name in st.session_state.rag_sources:
-            # st.toast("Documento ya cargado")
-            continue
+        elements.sort(key=lambda element: element.metadata.page_number or 0)
 
-        # hacer el archivo
-        file_path = f"./{session_folder}/{doc_file.name}"
-        with open(file_path, "wb") as file:
-            file.write(doc_file.read())
+    return elements
 
+
+def iter_element_ranges(file_path, timings=None, pages_per_range=PAGES_PER_RANGE):
+    """Entrega los elementos del archivo de a un rango de paginas por vez."""
+    timings = {} if timings is None else timings
+
+    page_count = None
+    if file_path.lower().endswith(".pdf"):
         try:
-            # Chunking (unstructured necesita el file path en el nombre)
-            with st.spinner(f"Procesando {doc_file.name}..."):
-                elements = partition(filename=file_path)
-
-            for element in elements:
-                element.text = clean(element.text, extra_whitespace=True)
-                element.text = replace_unicode_quotes(element.text)
-
-            chunks = chunk_elements(elements)
-
-            # Transformar chunks de unstructured en documentos
-            for i, chunk in enumerate(chunks):
-                metadata_dict = dict(chunk.metadata.to_dict())
-
-                clean_metadata = {
-                    "source": doc_file.name,
-                    "chunk_id": i,
-                    "page_number": metadata_dict.get("page_number", "None"),
-                    "filetype": metadata_dict.get("filetype", "None"),
-                    "filename": metadata_dict.get("filename", "None"),
-                    # Convertir listas a strings si existen
-                    "languages": ", ".join(metadata_dict.get("languages", []))
-                    if metadata_dict.get("languages")
-                    else None,
-                }
-
-                doc = Document(page_content=chunk.text, metadata=clean_metadata)
-                docs.append(doc)
-
-            st.session_state.rag_sources.append(doc_file.name)
-
-        except Exception as e:
-            st.toast(
-                f"Error al procesar el documento {doc_file.name}: {str(e)}", icon="🚨"
-            )
+            page_count = len(PdfReader(file_path).pages)
+        except Exception:
+            # PDF que pypdf no puede leer (cifrado, corrupto), que unstructured decida
+            page_count = None
+
+    if page_count is None:
+        started_at = time()
+        elements = partition(filename=file_path)
+        timings["auto"] = timings.get("auto", 0.0) + time() - started_at
+        yield elements
+        return
 
-    if os.path.exists(session_folder):
-        shutil.rmtree(session_folder)
+    for first_page in range(1, page_count + 1, pages_per_range):
+        last_page = min(first_page + pages_per_range - 1, page_count)
+        yield partition_pdf_range(file_path, first_page, last_page, timings)
 
-    if docs:
-        add_docs(docs)
-        st.toast(
-            f"Documento {str([doc_file.name for doc_file in st.session_state.rag_docs])[1:-1]} cargado",
-            icon="✅",
-        )
 
+def iter_chunk_batches(element_ranges, source, batch_size=INGEST_BATCH_SIZE):
+    """Limpia y agrupa en chunks cada rango, con chunk_id correlativo en el archivo."""
+    chunk_id = 0
+
+    for elements in element_ranges:
+        for element in elements:
+            element.text = clean(element.text, extra_whitespace=True)
+            element.text = replace_unicode_quotes(element.text)
 
-def initialize_vector_db(docs):
-    vector_db = Chroma.from_documents(
-        documents=docs,
-        embedding=GoogleGenerativeAIEmbeddings(
-            api_key=st.session_state.gemini_api_key,
-            model="gemini-embedding-001",
-            task_type="RETRIEVAL_DOCUMENT",
-        ),
-        # para aislar los documentos por sesión/usuario
-        collection_name=f"{int(time() * 1000)}_" + st.session_state["session_id"],
+        docs = []
+        for chunk in chunk_elements(elements):
+            docs.append(chunk_to_doc(chunk, source, chunk_id))
+            chunk_id += 1
+
+        for start in range(0, len(docs), batch_size):
+            yield docs[start : start + batch_size]
+
+
+def iter_doc_batches(file_path, source, batch_size=INGEST_BATCH_SIZE, timings=None):
+    """Lotes de Documents del archivo, particionando y limpiando en paralelo.
+
+    El particionado por rangos y el chunking corren en sus propios hilos,
+    mientras quien itera (el embedding) consume los lotes ya listos.
+    """
+    return pipeline(
+        iter_element_ranges(file_path, timings),
+        partial(iter_chunk_batches, source=source, batch_size=batch_size),
     )
 
-    return vector_db
 
+def ingest_file(job, vector_db, rag_sources):
+    """Trabajo de ingesta: corre en segundo plano, sin acceso a st.session_state.
+
+    Cada lote queda buscable apenas se agrega a la coleccion. Si el archivo
+    falla a mitad de camino se eliminan los lotes ya agregados. Un trabajo
+    cancelado para entre lotes.
+    """
+    ids = []
+    try:
+        # closing() detiene las etapas del pipeline si el embedding falla
+        with closing(
+            iter_doc_batches(job.file_path, job.filename, timings=job.timings)
+        ) as batches:
+            for batch in batches:
+                job.check_cancelled()
+                ids.extend(vector_db.add_documents(batch))
+                job.chunks_done += len(batch)
+
+        job.check_cancelled()
+        rag_sources.append(job.filename)
+        # los demas procesos leen los documentos de la sesion desde la base
+        add_session_source(job.session_id, job.filename)
+    except Exception:
+        # al cancelar, la sesion se cierra y borra la coleccion entera
+        if ids and not job.cancelled:
+            vector_db.delete(ids=ids)
+        job.chunks_done = 0
+        raise
+    finally:
+        shutil.rmtree(os.path.dirname(job.file_path), ignore_errors=True)
+
+
+# chromadb no es thread-safe al crear clientes que comparten el mismo sistema
+chroma_client_lock = threading.Lock()
+
+
+def chroma_location():
+    """Argumentos de Chroma: servidor compartido, directorio local o memoria."""
+    if CHROMA_HOST:
+        return {"host": CHROMA_HOST, "port": CHROMA_PORT}
+    return {"persist_directory": CHROMA_PERSIST_DIR}
+
+
+def initialize_vector_db(api_key, session_id, docs=None, base_url=None):
+    embedding = GoogleGenerativeAIEmbeddings(
+        api_key=api_key,
+        model="gemini-embedding-001",
+        task_type="RETRIEVAL_DOCUMENT",
+        base_url=base_url,
+    )
+    # comparte la cuota de la key con el chat, que tiene prioridad
+    embedding = ScheduledEmbeddings(
+        UsageEmbeddings(embedding, session_id), get_scheduler(api_key)
+    )
+    # para aislar los documentos por sesión/usuario, con CHROMA_HOST cualquier
+    # proceso del servidor puede reabrir la coleccion de la sesion
+    collection_name = f"session_{session_id}"
+
+    if not docs:
+        with chroma_client_lock:
+            return Chroma(
+                collection_name=collection_name,
+                embedding_function=embedding,
+                **chroma_location(),
+            )
 
-def add_docs(docs):
-    if "vector_db" not in st.session_state:
-        st.session_state.vector_db = initialize_vector_db(docs)
-        return
+    with chroma_client_lock:
+        vector_db = Chroma.from_documents(
+            documents=docs,
+            embedding=embedding,
+            collection_name=collection_name,
+            **chroma_location(),
+        )
 
-    st.session_state.vector_db.add_documents(docs)
+    return vector_db
 
 
 # RAG
-def get_conversational_rag_chain(agent):
-    retriever = st.session_state.vector_db.as_retriever(
-        search_kwargs={"k": RETRIEVER_K}
+def get_conversational_rag_chain(agent, vector_db, k=RETRIEVER_K):
+    retriever = vector_db.as_retriever(
+        search_kwargs={"k": k}
     )
 
     retriever_prompt = ChatPromptTemplate.from_messages(
         [
-            MessagesPlaceholder(variable_name="messages"),
+            MessagesPlaceholder(variable_name="chat_history"),
             ("user", "{input}"),
             (
                 "user",
@@ -137,7 +287,10 @@ def get_conversational_rag_chain(agent):
         ]
     )
 
-    retriever_chain = create_history_aware_retriever(agent, retriever, retriever_prompt)
+    # los tags identifican la etapa en el registro de consumo
+    retriever_chain = create_history_aware_retriever(
+        agent.with_config(tags=[REWRITE]), retriever, retriever_prompt
+    )
 
     main_prompt = ChatPromptTemplate.from_messages(
         [
@@ -152,10 +305,10 @@ def get_conversational_rag_chain(agent):
     Contexto:
     {context}""",
             ),
-            MessagesPlaceholder(variable_name="messages"),
+            MessagesPlaceholder(variable_name="chat_history"),
             ("user", "{input}"),
         ]
     )
 
-    qa_chain = create_stuff_documents_chain(agent, main_prompt)
+    qa_chain = create_stuff_documents_chain(agent.with_config(tags=[ANSWER]), main_prompt)
     return create_retrieval_chain(retriever_chain, qa_chain)
@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import os
+import threading
+from itertools import count
+from math import ceil
+from time import monotonic
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from langchain_core.rate_limiters import BaseRateLimiter
+
+# Cuota por API key, compartida por chat, reescritura de consultas y embeddings.
+# 0 desactiva el limite
+REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_RPM", 60))
+TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TPM", 250_000))
+# Tokens que se reservan por llamada al chat, se ajustan con el uso real al terminar
+CHAT_TOKEN_ESTIMATE = 2_000
+# textos por request de GoogleGenerativeAIEmbeddings.embed_documents
+EMBED_BATCH_SIZE = 100
+
+# Prioridades: menor se atiende primero
+INTERACTIVE = 0  # chat, reescritura de la consulta y embedding de la consulta
+BULK = 1  # embeddings de la ingesta
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+
+def estimate_tokens(text):
+    # aproximacion de Gemini: ~4 caracteres por token
+    return max(1, len(text) // 4)
+
+
+class KeyScheduler:
+    """Presupuesto de requests y tokens por minuto para una API key.
+
+    Las llamadas esperan en una cola por prioridad en vez de fallar con 429:
+    solo la primera de la cola puede tomar cuota, asi el chat del usuario pasa
+    delante de los embeddings de una ingesta grande.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._cond = threading.Condition()
+        self._queue = []  # heap de (prioridad, orden de llegada)
+        self._arrivals = count()
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = monotonic()
+
+        self._granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._wait_total = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._wait_max = {priority: 0.0 for priority in PRIORITY_NAMES}
+
+    def _refill(self):
+        now = monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(
+            self.requests_per_minute,
+            self._requests + elapsed * self.requests_per_minute / 60,
+        )
+        self._tokens = min(
+            self.tokens_per_minute,
+            self._tokens + elapsed * self.tokens_per_minute / 60,
+        )
+
+    def _seconds_until(self, requests, tokens):
+        # un limite en 0 no restringe
+        wait = 0.0
+        if self.requests_per_minute:
+            missing_requests = max(0.0, requests - self._requests)
+            wait = max(wait, missing_requests * 60 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            missing_tokens = max(0.0, tokens - self._tokens)
+            wait = max(wait, missing_tokens * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, priority=INTERACTIVE, tokens=0, requests=1, blocking=True):
+        """Espera su turno y descuenta la cuota. False si no bloquea y no hay cuota."""
+        # una llamada mas grande que el presupuesto completo nunca entraria
+        tokens = min(tokens, self.tokens_per_minute)
+        requests = min(requests, self.requests_per_minute)
+
+        with self._cond:
+            ticket = (priority, next(self._arrivals))
+            heapq.heappush(self._queue, ticket)
+            started_at = monotonic()
+
+            try:
+                while True:
+                    self._refill()
+                    is_next = self._queue[0] == ticket
+                    wait = self._seconds_until(requests, tokens)
+
+                    if is_next and wait == 0:
+                        self._requests -= requests
+                        self._tokens -= tokens
+                        self._record_wait(priority, monotonic() - started_at)
+                        return True
+
+                    if not blocking:
+                        return False
+
+                    # el primero duerme hasta que haya cuota, el resto hasta que avance la cola
+                    self._cond.wait(timeout=wait if is_next else None)
+            finally:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+
+    def settle(self, tokens):
+        """Ajusta la reserva con el uso real (`tokens` > 0 si se gasto mas)."""
+        if not self.tokens_per_minute:
+            return
+
+        with self._cond:
+            self._refill()
+            self._tokens -= tokens
+            self._cond.notify_all()
+
+    def _record_wait(self, priority, wait):
+        self._granted[priority] += 1
+        self._wait_total[priority] += wait
+        self._wait_max[priority] = max(self._wait_max[priority], wait)
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._queue:
+                queued[PRIORITY_NAMES[priority]] += 1
+
+            return {
+                "queued": queued,
+                "available_requests": round(self._requests, 2),
+                "available_tokens": round(self._tokens),
+                "granted": {
+                    PRIORITY_NAMES[p]: granted for p, granted in self._granted.items()
+                },
+                "wait_avg_s": {
+                    PRIORITY_NAMES[p]: round(self._wait_total[p] / granted, 3)
+                    if granted
+                    else 0.0
+                    for p, granted in self._granted.items()
+                },
+                "wait_max_s": {
+                    PRIORITY_NAMES[p]: round(wait, 3)
+                    for p, wait in self._wait_max.items()
+                },
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(api_key):
+    """El scheduler de la API key, compartido por todo el proceso."""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(api_key)
+        if scheduler is None:
+            scheduler = _schedulers[api_key] = KeyScheduler(
+                REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+            )
+        return scheduler
+
+
+def all_scheduler_stats():
+    # sin exponer la key, solo sus ultimos caracteres
+    with _schedulers_lock:
+        schedulers = list(_schedulers.items())
+    return {f"...{api_key[-4:]}": s.stats() for api_key, s in schedulers}
+
+
+class SchedulerRateLimiter(BaseRateLimiter):
+    """Rate limiter de LangChain para el modelo de chat (prioridad interactiva)."""
+
+    def __init__(self, scheduler, priority=INTERACTIVE):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def acquire(self, *, blocking=True):
+        return self.scheduler.acquire(
+            self.priority, tokens=CHAT_TOKEN_ESTIMATE, blocking=blocking
+        )
+
+    async def aacquire(self, *, blocking=True):
+        return await asyncio.to_thread(self.acquire, blocking=blocking)
+
+
+class UsageSettler(BaseCallbackHandler):
+    """Corrige la reserva de CHAT_TOKEN_ESTIMATE con los tokens que informa Gemini."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    self.scheduler.settle(usage["total_tokens"] - CHAT_TOKEN_ESTIMATE)
+
+
+class ScheduledEmbeddings(Embeddings):
+    """Embeddings que pasan por el scheduler: consultas interactivas, documentos bulk."""
+
+    def __init__(self, embeddings, scheduler):
+        self.embeddings = embeddings
+        self.scheduler = scheduler
+
+    def embed_documents(self, texts):
+        self.scheduler.acquire(
+            BULK,
+            tokens=sum(estimate_tokens(text) for text in texts),
+            requests=ceil(len(texts) / EMBED_BATCH_SIZE),
+        )
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        self.scheduler.acquire(INTERACTIVE, tokens=estimate_tokens(text))
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,235 @@
+# API HTTP de DocuChat sobre el mismo Engine que usa la UI de Streamlit.
+#
+#   uvicorn server:app --workers 4
+#
+# Cada proceso tiene sus propias sesiones en memoria. Con varios workers las
+# colecciones tienen que estar en un servidor de Chroma (`chroma run`, con
+# CHROMA_HOST) y el historial en un DOCUCHAT_DB_PATH compartido: el cliente
+# persistente de CHROMA_PERSIST_DIR es de un solo proceso.
+import json
+from uuid import uuid4
+
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from chat_store import HISTORY_PAGE_SIZE, is_conversation_owner, load_messages
+from engine import Engine, EngineError, NotFoundError, key_owner
+from ratelimit import all_scheduler_stats
+from usage import (
+    GROUP_COLUMNS,
+    budget_status,
+    ingest_budget_status,
+    usage_totals,
+)
+
+API_KEY_HEADER = "X-Gemini-Api-Key"
+# Mensajes por pagina del historial como maximo
+MAX_PAGE_SIZE = 100
+
+engine = Engine()
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.job_id,
+        "filename": job.filename,
+        "status": job.status,
+        "chunks_done": job.chunks_done,
+        "error": job.error,
+        "timings": job.timings,
+    }
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def get_api_key(request):
+    api_key = request.headers.get(API_KEY_HEADER)
+    if not api_key:
+        raise EngineError(f"Falta el header {API_KEY_HEADER}")
+    return api_key
+
+
+def query_param(request, name, convert, default=None):
+    """Parametro de la query convertido con `convert`, EngineError si no es valido."""
+    value = request.query_params.get(name)
+    if not value:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        raise EngineError(f"Parámetro {name} inválido")
+
+
+async def get_session(request):
+    api_key = get_api_key(request)
+
+    # puede reabrir una coleccion persistida, no bloquear el event loop
+    return await run_in_threadpool(
+        engine.get_session, request.path_params["session_id"], api_key
+    )
+
+
+async def create_session(request):
+    return JSONResponse({"session_id": str(uuid4())}, status_code=201)
+
+
+async def delete_session(request):
+    await run_in_threadpool(
+        engine.close_session, request.path_params["session_id"], get_api_key(request)
+    )
+    return Response(status_code=204)
+
+
+async def upload_documents(request):
+    session = await get_session(request)
+
+    jobs = []
+    async with request.form() as form:
+        for upload in form.getlist("files"):
+            data = await upload.read()
+            job = await run_in_threadpool(engine.ingest, session, upload.filename, data)
+            if job is not None:
+                jobs.append(job_to_dict(job))
+
+    return JSONResponse({"jobs": jobs}, status_code=202)
+
+
+async def list_documents(request):
+    session = await get_session(request)
+
+    return JSONResponse(
+        {
+            "sources": list(session.rag_sources),
+            "jobs": [job_to_dict(job) for job in session.ingest_jobs],
+            "rag_ready": session.is_rag_ready,
+        }
+    )
+
+
+def chat_events(stream, tool_calls):
+    try:
+        for text in stream:
+            while tool_calls:
+                yield sse_event("tool", {"name": tool_calls.pop(0)})
+            yield sse_event("token", {"text": text})
+    except Exception as e:
+        yield sse_event("error", {"error": str(e)})
+        return
+
+    yield sse_event("done", {})
+
+
+async def chat(request):
+    session = await get_session(request)
+    try:
+        body = await request.json()
+    except ValueError:
+        raise EngineError("El cuerpo debe ser JSON")
+
+    if not isinstance(body, dict):
+        raise EngineError("El cuerpo debe ser un objeto JSON")
+    if not body.get("message") or not body.get("conversation_id"):
+        raise EngineError("Se requieren conversation_id y message")
+
+    tool_calls = []
+    stream = await run_in_threadpool(
+        engine.stream_chat,
+        session,
+        body["conversation_id"],
+        body["message"],
+        use_rag=bool(body.get("use_rag")),
+        on_tool_call=tool_calls.append,
+    )
+
+    # el stream es sincrono (LangChain), se consume en el threadpool
+    return StreamingResponse(
+        iterate_in_threadpool(chat_events(stream, tool_calls)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+async def list_messages(request):
+    conversation_id = request.path_params["conversation_id"]
+    before_id = query_param(request, "before_id", int)
+    limit = query_param(request, "limit", int, HISTORY_PAGE_SIZE)
+    # un limite negativo en SQLite no limita
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise EngineError(f"limit debe estar entre 1 y {MAX_PAGE_SIZE}")
+
+    # solo quien creo la conversacion (con la misma API key) puede leerla
+    owner = key_owner(get_api_key(request))
+    if not await run_in_threadpool(is_conversation_owner, conversation_id, owner):
+        raise NotFoundError("Conversación no encontrada")
+
+    messages = await run_in_threadpool(
+        load_messages,
+        conversation_id,
+        limit=limit,
+        before_id=before_id,
+    )
+    return JSONResponse({"messages": messages})
+
+
+async def session_usage(request):
+    session_id = request.path_params["session_id"]
+    await run_in_threadpool(engine.check_session_owner, session_id, get_api_key(request))
+
+    stages = await run_in_threadpool(usage_totals, ["stage"], session_id=session_id)
+    return JSONResponse(
+        {
+            "budget": await run_in_threadpool(budget_status, session_id),
+            "ingest_budget": await run_in_threadpool(
+                ingest_budget_status, session_id
+            ),
+            "total_tokens": sum(stage["total_tokens"] for stage in stages),
+            "stages": stages,
+        }
+    )
+
+
+async def usage_report(request):
+    # totales para planificar capacidad, p.ej. /usage?by=stage&by=model
+    by = request.query_params.getlist("by") or GROUP_COLUMNS
+    since = query_param(request, "since", float)
+
+    totals = await run_in_threadpool(usage_totals, by, since=since)
+    return JSONResponse({"totals": totals})
+
+
+async def rate_limits(request):
+    # cola y esperas por API key de este proceso
+    return JSONResponse({"keys": all_scheduler_stats()})
+
+
+async def engine_error(request, exc):
+    status_code = 404 if isinstance(exc, NotFoundError) else 400
+    return JSONResponse({"error": str(exc)}, status_code=status_code)
+
+
+app = Starlette(
+    routes=[
+        Route("/sessions", create_session, methods=["POST"]),
+        Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+        Route(
+            "/sessions/{session_id}/documents",
+            upload_documents,
+            methods=["POST"],
+        ),
+        Route("/sessions/{session_id}/documents", list_documents, methods=["GET"]),
+        Route("/sessions/{session_id}/chat", chat, methods=["POST"]),
+        Route("/sessions/{session_id}/usage", session_usage, methods=["GET"]),
+        Route(
+            "/conversations/{conversation_id}/messages",
+            list_messages,
+            methods=["GET"],
+        ),
+        Route("/usage", usage_report, methods=["GET"]),
+        Route("/limits", rate_limits, methods=["GET"]),
+    ],
+    exception_handlers={EngineError: engine_error},
+)
@@ -2,24 +2,7 @@ import pytest
 from unittest.mock import MagicMock, Mock, patch
 from agent import llm_stream, stream_llm_rag_response
 
-@pytest.fixture
-def mock_streamlit(monkeypatch):
-    mock_st = Mock()
-    mock_st.toast = Mock()
-    mock_st.session_state.messages = []
-    monkeypatch.setattr("agent.st", mock_st)
-
-    return mock_st
-
-@pytest.fixture
-def mock_streamlit_session():
-    with patch("agent.st") as mock_st:
-        mock_st.session_state.gemini_api_key = "test_api_key"
-        mock_st.session_state.messages = []
-        yield mock_st
-
-
-def test_llm_stream(mock_streamlit):
+def test_llm_stream():
     mock_agent = Mock()
 
     mock_agent.stream.return_value = [
@@ -38,10 +21,8 @@ def test_llm_stream(mock_streamlit):
     result = list(llm_stream(mock_agent, messages))
 
     assert result == ["Hola ", "mundo"]
-    assert len(mock_streamlit.session_state.messages) == 1
-    assert mock_streamlit.session_state.messages[0]["content"] == "Hola mundo"
 
-def test_stream_llm_rag_response(mock_streamlit_session):
+def test_stream_llm_rag_response():
     mock_chain = Mock()
     mock_chain.stream.return_value = [
         {
@@ -53,10 +34,15 @@ def test_stream_llm_rag_response(mock_streamlit_session):
         {"answer": "la respuesta"}
     ]
     
-    with patch("agent.get_conversational_rag_chain", return_value=mock_chain):
+    with patch("agent.get_conversational_rag_chain", return_value=mock_chain) as mock_get:
         messages = [Mock(content="test query")]
+        vector_db = Mock()
         
-        result = list(stream_llm_rag_response(Mock(), messages))
+        result = list(stream_llm_rag_response(Mock(), messages, vector_db))
+
+        assert mock_get.call_args[0][1] is vector_db
+        # la consulta solo se reescribe si el historial llega como chat_history
+        assert set(mock_chain.stream.call_args[0][0]) == {"chat_history", "input"}
 
         assert "Esta es " in result
         assert "la respuesta" in result
@@ -64,7 +50,7 @@ def test_stream_llm_rag_response(mock_streamlit_session):
 
 
 
-def test_llm_stream_tool_toast(mock_streamlit):
+def test_llm_stream_tool_toast():
     mock_agent = Mock()
 
     mock_agent.stream.return_value = [
@@ -77,6 +63,7 @@ def test_llm_stream_tool_toast(mock_streamlit):
     ]
 
     messages = [{"role": "user", "content": "test"}]
-    list(llm_stream(mock_agent, messages))
-    # Verificar que se llamó toast
-    mock_streamlit.toast.assert_called_once_with("Usando herramienta: buscar_documento")
+    on_tool_call = Mock()
+    list(llm_stream(mock_agent, messages, on_tool_call))
+    # Verificar que se aviso de la herramienta
+    on_tool_call.assert_called_once_with("buscar_documento")
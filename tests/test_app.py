@@ -1,8 +1,12 @@
 # from unittest.mock import MagicMock, Mock, patch
 
-import pytest
 from streamlit.testing.v1 import AppTest
 
+import chat_store
+from engine import key_owner
+
+OWNER = key_owner("dummy-key")
+
 
 def test_app_render_without_key():
     at = AppTest.from_file("../app.py", default_timeout=10).run()
@@ -18,3 +22,30 @@ def test_app_accepts_api_key():
     at.text_input("file_qa_api_key").input("dummy-key").run()
     assert not at.exception
 
+
+def test_app_resumes_saved_conversation():
+    chat_store.add_message("conv1", "user", "Pregunta guardada", OWNER)
+    chat_store.add_message("conv1", "assistant", "Respuesta guardada", OWNER)
+
+    at = AppTest.from_file("../app.py")
+    at.query_params["conversation"] = "conv1"
+    at.run(timeout=10)
+    at.text_input("file_qa_api_key").input("dummy-key").run()
+
+    assert not at.exception
+    rendered = [message.markdown[0].value for message in at.chat_message]
+    assert rendered == ["Pregunta guardada", "Respuesta guardada"]
+
+
+def test_app_does_not_open_conversation_of_other_key():
+    chat_store.add_message("conv1", "user", "Pregunta ajena", key_owner("otra-key"))
+
+    at = AppTest.from_file("../app.py")
+    at.query_params["conversation"] = "conv1"
+    at.run(timeout=10)
+    at.text_input("file_qa_api_key").input("dummy-key").run()
+
+    assert not at.exception
+    assert at.query_params["conversation"] != ["conv1"]
+    rendered = [message.markdown[0].value for message in at.chat_message]
+    assert "Pregunta ajena" not in rendered
@@ -0,0 +1,117 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+import chat_store
+from chat_store import (
+    NotOwnerError,
+    add_message,
+    add_session_source,
+    claim_session,
+    delete_session,
+    has_older_messages,
+    is_conversation_owner,
+    is_session_owner,
+    list_conversations,
+    load_messages,
+    load_session_sources,
+)
+
+
+def test_add_and_load_messages():
+    add_message("conv1", "user", "Hola", "owner1")
+    add_message("conv1", "assistant", "Hola, soy DocuChat", "owner1")
+    add_message("conv2", "user", "Otra conversacion", "owner1")
+
+    messages = load_messages("conv1")
+
+    assert [(m["role"], m["content"]) for m in messages] == [
+        ("user", "Hola"),
+        ("assistant", "Hola, soy DocuChat"),
+    ]
+
+
+def test_load_messages_paginates_from_most_recent():
+    ids = [add_message("conv1", "user", f"mensaje {i}", "owner1") for i in range(5)]
+
+    recent = load_messages("conv1", limit=2)
+    assert [m["content"] for m in recent] == ["mensaje 3", "mensaje 4"]
+
+    older = load_messages("conv1", limit=2, before_id=recent[0]["id"])
+    assert [m["content"] for m in older] == ["mensaje 1", "mensaje 2"]
+
+    assert has_older_messages("conv1", older[0]["id"])
+    assert not has_older_messages("conv1", ids[0])
+
+
+def test_list_conversations_most_recent_first():
+    add_message("conv1", "user", "Primera conversacion", "owner1")
+    add_message("conv2", "user", "Segunda conversacion", "owner1")
+    add_message("conv1", "assistant", "Respuesta", "owner1")
+
+    conversations = list_conversations("owner1")
+
+    assert [c["id"] for c in conversations] == ["conv1", "conv2"]
+    # el titulo es el primer mensaje
+    assert conversations[0]["title"] == "Primera conversacion"
+
+
+def test_conversations_are_scoped_to_owner():
+    add_message("conv1", "user", "De owner1", "owner1")
+    add_message("conv2", "user", "De owner2", "owner2")
+
+    assert [c["id"] for c in list_conversations("owner1")] == ["conv1"]
+    assert is_conversation_owner("conv1", "owner1")
+    assert not is_conversation_owner("conv1", "owner2")
+    # una conversacion nueva es de quien la empiece
+    assert is_conversation_owner("conv3", "owner2")
+
+
+def test_add_message_refuses_other_owner():
+    add_message("conv1", "user", "De owner1", "owner1")
+
+    with pytest.raises(NotOwnerError):
+        add_message("conv1", "user", "inyectado por owner2", "owner2")
+
+    assert [m["content"] for m in load_messages("conv1")] == ["De owner1"]
+
+
+def test_migrates_conversations_without_owner(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "old.db")
+    with closing(sqlite3.connect(db_path)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE conversations (id TEXT PRIMARY KEY, title TEXT NOT NULL,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("INSERT INTO conversations VALUES ('old', 'Vieja', 0, 0)")
+    monkeypatch.setattr(chat_store, "CHAT_DB_PATH", db_path)
+
+    add_message("conv1", "user", "Nueva", "owner1")
+
+    assert [c["id"] for c in list_conversations("owner1")] == ["conv1"]
+    # las conversaciones sin dueño no quedan accesibles para nadie
+    assert not is_conversation_owner("old", "owner1")
+
+
+def test_sessions_are_scoped_to_owner():
+    assert claim_session("s1", "owner1")
+    assert claim_session("s1", "owner1")
+    assert not claim_session("s1", "owner2")
+    assert not is_session_owner("s1", "owner2")
+    assert is_session_owner("s2", "owner2")
+
+    delete_session("s1")
+    assert claim_session("s1", "owner2")
+
+
+def test_session_sources():
+    add_session_source("s1", "doc2.pdf")
+    add_session_source("s1", "doc1.pdf")
+    add_session_source("s1", "doc1.pdf")
+    add_session_source("s2", "doc3.pdf")
+
+    assert load_session_sources("s1") == ["doc1.pdf", "doc2.pdf"]
+    delete_session("s1")
+    assert load_session_sources("s1") == []
+    assert load_session_sources("s2") == ["doc3.pdf"]
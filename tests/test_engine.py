@@ -0,0 +1,357 @@
+from time import sleep
+from unittest.mock import Mock, mock_open, patch
+
+import pytest
+
+import chat_store
+from engine import (
+    DEGRADED_HISTORY_MESSAGES,
+    DEGRADED_RETRIEVER_K,
+    Engine,
+    EngineError,
+    NotFoundError,
+    Session,
+    key_owner,
+)
+from ingest import FAILED, QUEUED, IngestJob
+from rag import ingest_file
+from usage import BUDGET_HARD, BUDGET_SOFT
+
+
+OWNER = key_owner("test_api_key")
+
+
+@pytest.fixture
+def engine():
+    return Engine()
+
+
+@pytest.fixture
+def session():
+    return Session(session_id="test_session_id", api_key="test_api_key")
+
+
+@pytest.fixture
+def ingest_job():
+    return IngestJob(
+        session_id="test_session_id",
+        filename="test_document.pdf",
+        file_path="/tmp/source_files_test/test_document.pdf",
+    )
+
+
+def test_get_session_reuses_session(engine):
+    session = engine.get_session("test_session_id", "test_api_key")
+
+    assert engine.get_session("test_session_id", "test_api_key") is session
+    assert session.owner == OWNER
+    assert engine.get_session("otra_sesion", "test_api_key") is not session
+    assert engine.session_ids() == ["test_session_id", "otra_sesion"]
+
+
+def test_get_session_refuses_other_key(engine):
+    session = engine.get_session("test_session_id", "test_api_key")
+
+    with pytest.raises(NotFoundError):
+        engine.get_session("test_session_id", "otra_key")
+
+    assert session.api_key == "test_api_key"
+    # tambien en otro proceso, que no tiene la sesion en memoria
+    with pytest.raises(NotFoundError):
+        Engine().get_session("test_session_id", "otra_key")
+
+
+@patch("engine.initialize_vector_db")
+@patch("engine.CHROMA_PERSIST_DIR", "/tmp/chroma")
+def test_get_session_reopens_persisted_collection(mock_init, engine):
+    chat_store.add_session_source("test_session_id", "doc1.pdf")
+
+    session = engine.get_session("test_session_id", "test_api_key")
+
+    mock_init.assert_called_once_with(
+        "test_api_key", "test_session_id", base_url=None
+    )
+    assert session.rag_sources == ["doc1.pdf"]
+    assert session.is_rag_ready
+
+
+@patch("engine.initialize_vector_db")
+@patch("engine.CHROMA_PERSIST_DIR", "/tmp/chroma")
+def test_get_session_without_documents_creates_no_collection(mock_init, engine):
+    session = engine.get_session("test_session_id", "test_api_key")
+
+    mock_init.assert_not_called()
+    assert session.vector_db is None
+
+
+@patch("engine.initialize_vector_db")
+@patch("engine.CHROMA_HOST", "chroma")
+def test_get_session_refreshes_sources_from_chroma_server(mock_init, engine):
+    session = engine.get_session("test_session_id", "test_api_key")
+    assert not session.is_rag_ready
+
+    # otro worker termino de cargar un documento en la coleccion compartida
+    chat_store.add_session_source("test_session_id", "doc1.pdf")
+    chat_store.add_session_source("test_session_id", "doc2.pdf")
+    session.ingest_jobs.append(
+        IngestJob(session_id="test_session_id", filename="doc2.pdf", file_path="x")
+    )
+
+    assert engine.get_session("test_session_id", "test_api_key") is session
+    assert session.rag_sources == ["doc1.pdf"]
+    assert session.is_rag_ready
+    mock_init.assert_called_once()
+
+
+def test_close_session_deletes_collection(engine):
+    session = engine.get_session("test_session_id", "test_api_key")
+    session.vector_db = Mock()
+
+    session.ingest_jobs.append(
+        IngestJob(session_id="test_session_id", filename="doc.pdf", file_path="x")
+    )
+
+    engine.close_session("test_session_id")
+
+    session.vector_db.delete_collection.assert_called_once()
+    assert session.ingest_jobs[0].cancelled
+    assert engine.get_session("test_session_id", "test_api_key") is not session
+
+
+def test_close_session_of_other_key(engine):
+    session = engine.get_session("test_session_id", "test_api_key")
+
+    with pytest.raises(NotFoundError):
+        engine.close_session("test_session_id", "otra_key")
+
+    assert engine.get_session("test_session_id", "test_api_key") is session
+    engine.close_session("test_session_id", "test_api_key")
+    # una vez cerrada la sesion el id queda libre
+    assert engine.get_session("test_session_id", "otra_key").owner == key_owner(
+        "otra_key"
+    )
+
+
+def test_evict_idle_sessions(engine):
+    idle = engine.get_session("s1", "test_api_key")
+    idle.vector_db = Mock()
+    engine.get_session("s2", "test_api_key").ingest_jobs.append(
+        IngestJob(session_id="s2", filename="doc.pdf", file_path="x")
+    )
+    engine.get_session("s3", "test_api_key")
+    sleep(0.1)
+    # otro worker sigue usando s3
+    chat_store.claim_session("s3", OWNER)
+
+    assert engine.evict_idle_sessions(max_idle=0.05) == ["s1"]
+    idle.vector_db.delete_collection.assert_called_once()
+    assert engine.session_ids() == ["s2", "s3"]
+    assert engine.evict_idle_sessions(max_idle=0) == []
+
+
+@patch("engine.submit_job")
+@patch("engine.initialize_vector_db")
+@patch("engine.tempfile.mkdtemp", return_value="/tmp/source_files_test")
+@patch("builtins.open", new_callable=mock_open)
+def test_ingest_success(
+    mock_file_open, mock_mkdtemp, mock_init, mock_submit, engine, session
+):
+    job = engine.ingest(session, "test_document.pdf", b"Contenido del archivo")
+
+    # La coleccion se crea vacia y el archivo se encola, sin procesarlo aqui
+    mock_init.assert_called_once_with(
+        "test_api_key", "test_session_id", base_url=None
+    )
+    mock_submit.assert_called_once_with(
+        job, ingest_file, mock_init.return_value, session.rag_sources
+    )
+    assert job.filename == "test_document.pdf"
+    assert job.file_path == "/tmp/source_files_test/test_document.pdf"
+    assert job.status == QUEUED
+    assert session.ingest_jobs == [job]
+    mock_file_open.return_value.write.assert_called_once_with(b"Contenido del archivo")
+
+
+@patch("engine.submit_job")
+@patch("engine.initialize_vector_db")
+@patch("engine.tempfile.mkdtemp", return_value="/tmp/source_files_test")
+@patch("builtins.open", new_callable=mock_open)
+def test_ingest_multiple_files(
+    mock_file_open, mock_mkdtemp, mock_init, mock_submit, engine, session
+):
+    engine.ingest(session, "doc1.pdf", b"Contenido 1")
+    engine.ingest(session, "doc2.pdf", b"Contenido 2")
+
+    assert mock_submit.call_count == 2
+    mock_init.assert_called_once()
+    assert [job.filename for job in session.ingest_jobs] == ["doc1.pdf", "doc2.pdf"]
+
+
+@patch("engine.submit_job")
+@patch("engine.tempfile.mkdtemp", return_value="/tmp/source_files_test")
+@patch("builtins.open", new_callable=mock_open)
+def test_ingest_strips_directories_from_filename(
+    mock_file_open, mock_mkdtemp, mock_submit, engine, session
+):
+    session.vector_db = Mock()
+
+    job = engine.ingest(session, "../../etc/doc.pdf", b"Contenido")
+
+    assert job.file_path == "/tmp/source_files_test/doc.pdf"
+
+
+@patch("engine.submit_job")
+def test_ingest_duplicated_docs(mock_submit, engine, session):
+    session.rag_sources.append("test_document.pdf")
+
+    assert engine.ingest(session, "test_document.pdf", b"Contenido") is None
+    mock_submit.assert_not_called()
+
+
+@patch("engine.submit_job")
+def test_ingest_skips_queued_files(mock_submit, engine, session, ingest_job):
+    # Un rerun mientras el archivo sigue en la cola no debe encolarlo de nuevo
+    session.ingest_jobs.append(ingest_job)
+
+    assert engine.ingest(session, ingest_job.filename, b"Contenido") is None
+    mock_submit.assert_not_called()
+
+
+@patch("engine.submit_job")
+@patch("engine.tempfile.mkdtemp", return_value="/tmp/source_files_test")
+@patch("builtins.open", new_callable=mock_open)
+def test_ingest_retries_failed_files(
+    mock_file_open, mock_mkdtemp, mock_submit, engine, session, ingest_job
+):
+    session.vector_db = Mock()
+    ingest_job.status = FAILED
+    session.ingest_jobs.append(ingest_job)
+
+    job = engine.ingest(session, ingest_job.filename, b"Contenido")
+
+    mock_submit.assert_called_once()
+    assert session.ingest_jobs == [job]
+    assert job.status == QUEUED
+
+
+def test_ingest_docs_limit(engine, session):
+    session.rag_sources.extend(f"doc{i}" for i in range(10))
+
+    with pytest.raises(EngineError):
+        engine.ingest(session, "test_document.pdf", b"Contenido")
+
+
+def test_ingest_limit_counts_pending_jobs(engine, session):
+    session.rag_sources.extend(f"doc{i}" for i in range(9))
+    session.ingest_jobs.append(
+        IngestJob(session_id="test_session_id", filename="doc9", file_path="x")
+    )
+
+    with pytest.raises(EngineError):
+        engine.ingest(session, "test_document.pdf", b"Contenido")
+
+
+@patch("engine.llm_stream")
+@patch("engine.build_agent")
+@patch("engine.build_model")
+def test_stream_chat_saves_turn(
+    mock_model, mock_agent, mock_llm_stream, engine, session
+):
+    mock_llm_stream.return_value = iter(["Hola ", "mundo"])
+    on_tool_call = Mock()
+
+    stream = engine.stream_chat(session, "conv1", "test", on_tool_call=on_tool_call)
+
+    # el mensaje del usuario se guarda antes de empezar el stream
+    assert [m["content"] for m in chat_store.load_messages("conv1")] == ["test"]
+    assert list(stream) == ["Hola ", "mundo"]
+
+    agent, messages, callback = mock_llm_stream.call_args[0]
+    assert agent is mock_agent.return_value
+    assert [m.content for m in messages] == ["test"]
+    assert callback is on_tool_call
+
+    saved = chat_store.load_messages("conv1")
+    assert [(m["role"], m["content"]) for m in saved] == [
+        ("user", "test"),
+        ("assistant", "Hola mundo"),
+    ]
+
+
+@patch("engine.stream_llm_rag_response")
+@patch("engine.build_agent")
+@patch("engine.build_model")
+def test_stream_chat_with_rag(
+    mock_model, mock_agent, mock_rag_stream, engine, session
+):
+    session.vector_db = Mock()
+    session.rag_sources.append("doc1.pdf")
+    mock_rag_stream.return_value = iter(["respuesta"])
+
+    assert list(engine.stream_chat(session, "conv1", "test", use_rag=True)) == [
+        "respuesta"
+    ]
+    assert mock_rag_stream.call_args[0][2] is session.vector_db
+
+
+def test_stream_chat_rag_without_docs(engine, session):
+    with pytest.raises(EngineError):
+        engine.stream_chat(session, "conv1", "test", use_rag=True)
+
+    assert chat_store.load_messages("conv1") == []
+
+
+@patch("engine.budget_status", return_value=BUDGET_SOFT)
+@patch("engine.stream_llm_rag_response")
+@patch("engine.build_agent")
+@patch("engine.build_model")
+def test_stream_chat_soft_budget_uses_less_context(
+    mock_model, mock_agent, mock_rag_stream, mock_budget, engine, session
+):
+    session.vector_db = Mock()
+    session.rag_sources.append("doc1.pdf")
+    mock_rag_stream.return_value = iter(["respuesta"])
+    for i in range(10):
+        chat_store.add_message("conv1", "user", f"mensaje {i}", OWNER)
+
+    list(engine.stream_chat(session, "conv1", "test", use_rag=True))
+
+    _, messages, _, k = mock_rag_stream.call_args[0]
+    assert len(messages) == DEGRADED_HISTORY_MESSAGES
+    assert messages[-1].content == "test"
+    assert k == DEGRADED_RETRIEVER_K
+    assert mock_rag_stream.call_args[1]["callbacks"][0].session_id == "test_session_id"
+
+
+@patch("engine.budget_status", return_value=BUDGET_HARD)
+def test_hard_budget_refuses_chat(mock_budget, engine, session):
+    with pytest.raises(EngineError):
+        engine.stream_chat(session, "conv1", "test")
+
+    assert chat_store.load_messages("conv1") == []
+
+
+@patch("engine.ingest_budget_status", return_value=BUDGET_HARD)
+def test_ingest_budget_refuses_documents(mock_budget, engine, session):
+    with pytest.raises(EngineError):
+        engine.ingest(session, "test_document.pdf", b"Contenido")
+
+    assert session.ingest_jobs == []
+
+
+def test_stream_chat_refuses_conversation_of_other_key(engine, session):
+    chat_store.add_message("conv1", "user", "Hola", key_owner("otra_key"))
+
+    with pytest.raises(NotFoundError):
+        engine.stream_chat(session, "conv1", "test")
+
+    assert [m["content"] for m in chat_store.load_messages("conv1")] == ["Hola"]
+
+
+@patch("engine.build_agent")
+@patch("engine.build_model")
+def test_get_model_cached_per_api_key(mock_model, mock_agent, engine):
+    assert engine.get_model("key1") == engine.get_model("key1")
+    engine.get_model("key2")
+
+    assert mock_model.call_count == 2
@@ -0,0 +1,136 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from ingest import (
+    CANCELLED,
+    DONE,
+    FAILED,
+    QUEUED,
+    IngestJob,
+    pipeline,
+    submit_job,
+)
+
+
+@pytest.fixture
+def job():
+    return IngestJob(
+        session_id="test_session_id",
+        filename="doc1.pdf",
+        file_path="/tmp/doc1.pdf",
+    )
+
+
+def test_submit_job_success(job):
+    fn = Mock()
+
+    assert job.status == QUEUED
+    assert job.is_active
+
+    submit_job(job, fn, "arg").result(timeout=5)
+
+    fn.assert_called_once_with(job, "arg")
+    assert job.status == DONE
+    assert not job.is_active
+    assert job.error is None
+    assert job.started_at <= job.finished_at
+
+
+def test_submit_job_failure(job):
+    fn = Mock(side_effect=Exception("Error de procesamiento"))
+
+    # Los errores quedan en el trabajo, no se propagan al Future
+    submit_job(job, fn).result(timeout=5)
+
+    assert job.status == FAILED
+    assert job.error == "Error de procesamiento"
+    assert not job.is_active
+
+
+def test_cancelled_job_does_not_run(job):
+    fn = Mock()
+    job.cancel()
+
+    submit_job(job, fn).result(timeout=5)
+
+    fn.assert_not_called()
+    assert job.status == CANCELLED
+    assert not job.is_active
+
+
+def test_job_cancelled_while_running(job):
+    def fn(job):
+        job.cancel()
+        job.check_cancelled()
+
+    submit_job(job, fn).result(timeout=5)
+
+    assert job.status == CANCELLED
+    assert job.error is None
+
+
+def test_sessions_take_turns():
+    release = threading.Event()
+    big = [
+        IngestJob(session_id="grande", filename=f"big{i}.pdf", file_path="x")
+        for i in range(2)
+    ]
+    small = IngestJob(session_id="chica", filename="small.pdf", file_path="x")
+
+    futures = [submit_job(job, lambda job: release.wait(5)) for job in big]
+    # el segundo archivo grande espera, el de la otra sesion no
+    submit_job(small, Mock()).result(timeout=5)
+
+    assert small.status == DONE
+    assert big[0].is_active
+    assert big[1].status == QUEUED
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert [job.status for job in big] == [DONE, DONE]
+
+
+def test_pipeline_runs_stages_in_order():
+    def double(items):
+        for item in items:
+            yield item * 2
+
+    def add_one(items):
+        for item in items:
+            yield item + 1
+
+    assert list(pipeline(range(10), double, add_one, maxsize=1)) == [
+        i * 2 + 1 for i in range(10)
+    ]
+
+
+def test_pipeline_propagates_stage_errors():
+    def source():
+        yield 1
+        raise ValueError("Error en la particion")
+
+    def identity(items):
+        yield from items
+
+    with pytest.raises(ValueError, match="Error en la particion"):
+        list(pipeline(source(), identity))
+
+
+def test_pipeline_stops_when_consumer_stops():
+    produced = []
+
+    def source():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    results = pipeline(source(), maxsize=1)
+    assert next(results) == 0
+    results.close()
+
+    time.sleep(0.5)
+    # la cola acotada no deja que la fuente avance mucho mas
+    assert len(produced) < 10
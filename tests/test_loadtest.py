@@ -0,0 +1,112 @@
+from unittest.mock import patch
+
+from unstructured.documents.elements import NarrativeText, Title
+
+import ratelimit
+from fake_gemini import prompt_text
+from loadtest import LoadStats, Window, limiter_stats, parse_args, percentile, run
+
+
+def test_percentile():
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 51
+    assert percentile(values, 99) == 99
+    assert percentile([], 95) is None
+
+
+def test_reservoir_keeps_bounded_samples():
+    stats = LoadStats(seed=1)
+
+    with patch("loadtest.RESERVOIR_SIZE", 10):
+        for i in range(100):
+            stats.record_turn(i, i)
+
+    assert stats.total.turns == 100
+    assert len(stats.total.ttft) == 10
+    # el intervalo guarda todo y se reinicia al leerlo
+    assert len(stats.take_interval().ttft) == 100
+    assert stats.interval == Window()
+
+
+def test_limiter_stats_sums_user_keys(monkeypatch):
+    monkeypatch.setattr(ratelimit, "_schedulers", {})
+    monkeypatch.setattr(ratelimit, "REQUESTS_PER_MINUTE", 0)
+    ratelimit.get_scheduler("k1").acquire(ratelimit.INTERACTIVE)
+    ratelimit.get_scheduler("k2").acquire(ratelimit.BULK)
+
+    limits = limiter_stats(["k1", "k2"])
+
+    assert limits["granted"] == {"interactive": 1, "bulk": 1}
+    assert limits["queued"] == {"interactive": 0, "bulk": 0}
+    # el loadtest no limita salvo que se pida con --rpm/--tpm
+    assert parse_args([]).rpm == parse_args([]).tpm == 0
+
+
+@patch("rag.partition")
+def test_run_short_load(mock_partition):
+    # unstructured necesita datos de nltk para markdown, no hace falta aqui
+    mock_partition.side_effect = lambda filename: [
+        Title(text="Seccion 1"),
+        NarrativeText(text="Contrato de servicio con plazo de entrega. " * 20),
+        NarrativeText(text="Informe de riesgo y presupuesto del proyecto. " * 20),
+    ]
+    args = parse_args(
+        [
+            "--sessions", "3",
+            "--duration", "3",
+            "--report-every", "1",
+            "--turns-per-session", "4",
+            "--upload-prob", "0.5",
+            "--think-time", "0.01",
+            "--ttft", "0.01",
+            "--token-delay", "0",
+            "--tokens", "5",
+            "--embed-latency", "0",
+            "--seed", "7",
+        ]
+    )
+    rows = []
+
+    summary = run(args, out=rows.append)
+
+    assert summary["turns"] > 0
+    assert summary["uploads"] > 0
+    assert summary["chunks"] > 0
+    assert summary["turn_errors"] == 0
+    assert summary["ttft_p95_s"] is not None
+    assert summary["leaked_collections"] == 0
+    assert summary["sessions"] > 0
+    assert summary["rss_growth_per_session_mb"] is not None
+    assert rows[-1].startswith("Resumen: ")
+
+
+@patch("rag.partition", side_effect=RuntimeError("partition"))
+def test_failed_ingest_jobs_count_as_upload_errors(mock_partition):
+    args = parse_args(
+        [
+            "--sessions", "2",
+            "--duration", "1",
+            "--report-every", "1",
+            "--turns-per-session", "3",
+            "--upload-prob", "1",
+            "--think-time", "0.01",
+            "--embed-latency", "0",
+            "--seed", "3",
+        ]
+    )
+
+    summary = run(args, out=lambda row: None)
+
+    assert summary["uploads"] == 0
+    assert summary["upload_errors"] > 0
+
+
+def test_fake_gemini_counts_system_instruction():
+    body = {
+        "systemInstruction": {"parts": [{"text": "contexto " * 400}]},
+        "contents": [{"role": "user", "parts": [{"text": "hola"}]}],
+    }
+
+    assert prompt_text(body).startswith("contexto")
+    assert prompt_text(body).endswith("hola")
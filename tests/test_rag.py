@@ -3,57 +3,19 @@ from unittest.mock import MagicMock, Mock, mock_open, patch
 
 import pytest
 from langchain_core.documents import Document
+from pypdf import PdfWriter
 
-from rag import add_docs, initialize_vector_db, load_doc_to_db
-
-
-class MockSessionState(dict):
-    """Mock personalizado para session_state que se comporta como dict y objeto"""
-
-    def __getattr__(self, name):
-        try:
-            return self[name]
-        except KeyError:
-            raise AttributeError(
-                f"'{type(self).__name__}' object has no attribute '{name}'"
-            )
-
-    def __setattr__(self, name, value):
-        self[name] = value
-
-    def __delattr__(self, name):
-        try:
-            del self[name]
-        except KeyError:
-            raise AttributeError(
-                f"'{type(self).__name__}' object has no attribute '{name}'"
-            )
-
-
-@pytest.fixture
-def mock_streamlit():
-    with patch("rag.st") as mock_st:
-        # Usar MockSessionState personalizado, se comporta raro si no
-        session_state = MockSessionState(
-            {
-                "gemini_api_key": "test_api_key",
-                "messages": [],
-                "session_id": "test_session_id",
-                "rag_sources": [],
-                "rag_docs": [],
-            }
-        )
-
-        mock_st.session_state = session_state
-
-        # Configurar métodos
-        mock_st.error = Mock()
-        mock_st.toast = Mock()
-        mock_st.spinner = MagicMock()
-        mock_st.spinner.return_value.__enter__ = Mock(return_value=None)
-        mock_st.spinner.return_value.__exit__ = Mock(return_value=None)
-
-        yield mock_st
+from chat_store import load_session_sources
+from ingest import IngestJob, JobCancelled
+from rag import (
+    OCR_STRATEGY,
+    find_scanned_pages,
+    ingest_file,
+    initialize_vector_db,
+    iter_chunk_batches,
+    iter_element_ranges,
+    partition_pdf_range,
+)
 
 
 @pytest.fixture
@@ -70,227 +32,291 @@ def sample_docs():
     ]
 
 
-@pytest.fixture
-def mock_uploaded_file():
-    mock_file = Mock()
-    mock_file.name = "test_document.pdf"
-    mock_file.read.return_value = b"Contenido del archivo"
-    return mock_file
-
-
 @patch("rag.Chroma")
 @patch("rag.GoogleGenerativeAIEmbeddings")
-def test_initialize_vector_db(
-    mock_embeddings, mock_chroma, mock_streamlit, sample_docs
-):
-    result = initialize_vector_db(sample_docs)
+def test_initialize_vector_db(mock_embeddings, mock_chroma, sample_docs):
+    result = initialize_vector_db("test_api_key", "test_session_id", sample_docs)
     mock_chroma.from_documents.assert_called_once()
     mock_embeddings.assert_called_once()
+    assert mock_embeddings.call_args[1]["api_key"] == "test_api_key"
+    assert (
+        mock_chroma.from_documents.call_args[1]["collection_name"]
+        == "session_test_session_id"
+    )
 
 
-def test_add_docs_initialization(mock_streamlit, sample_docs):
-    # Eliminar vector_db si existe
-    if "vector_db" in mock_streamlit.session_state:
-        del mock_streamlit.session_state["vector_db"]
-
-    with patch("rag.initialize_vector_db") as mock_init:
-        mock_init.return_value = Mock()
-        add_docs(sample_docs)
-        mock_init.assert_called_once_with(sample_docs)
-
-
-def test_add_docs_with_existing_db(mock_streamlit, sample_docs):
-    mock_vector_db = Mock()
-    mock_streamlit.session_state.vector_db = mock_vector_db
+@patch("rag.Chroma")
+@patch("rag.GoogleGenerativeAIEmbeddings")
+def test_initialize_empty_vector_db(mock_embeddings, mock_chroma):
+    result = initialize_vector_db("test_api_key", "test_session_id")
+    mock_chroma.from_documents.assert_not_called()
+    mock_chroma.assert_called_once()
+    assert result is mock_chroma.return_value
 
-    add_docs(sample_docs)
 
-    mock_vector_db.add_documents.assert_called_once_with(sample_docs)
+@patch("rag.Chroma")
+@patch("rag.GoogleGenerativeAIEmbeddings")
+@patch("rag.CHROMA_HOST", "chroma")
+def test_initialize_vector_db_on_chroma_server(mock_embeddings, mock_chroma):
+    initialize_vector_db("test_api_key", "test_session_id")
 
+    kwargs = mock_chroma.call_args[1]
+    assert (kwargs["host"], kwargs["port"]) == ("chroma", 8000)
+    assert "persist_directory" not in kwargs
 
-def test_load_doc_to_db_without_file(mock_streamlit):
-    mock_streamlit.session_state.rag_docs = []
-    load_doc_to_db()
-    mock_streamlit.error.assert_called_once()
 
+@pytest.fixture
+def mock_elements():
+    mock_element = Mock()
+    mock_element.text = "Texto de prueba"
+    mock_element.metadata.to_dict.return_value = {
+        "page_number": 1,
+        "filetype": "application/pdf",
+        "filename": "test_document.pdf",
+        "languages": ["es"],
+    }
 
-def test_load_doc_to_db_docs_limit(mock_streamlit, mock_uploaded_file):
-    mock_streamlit.session_state.rag_sources = [f"doc{i}" for i in range(10)]
-    mock_streamlit.session_state.rag_docs = [mock_uploaded_file]
-    load_doc_to_db()
-    mock_streamlit.error.assert_called_once()
+    mock_chunk = Mock()
+    mock_chunk.text = "Texto de prueba procesado"
+    mock_chunk.metadata = mock_element.metadata
 
+    return [mock_element], [mock_chunk]
 
-def test_load_doc_to_db_duplicated_docs(mock_streamlit, mock_uploaded_file):
-    mock_streamlit.session_state.rag_sources = [mock_uploaded_file.name]
-    mock_streamlit.session_state.rag_docs = [mock_uploaded_file]
 
-    with patch("rag.add_docs") as mock_add:
-        with patch("rag.os.path.exists", return_value=False):
-            with patch("rag.os.makedirs"):
-                load_doc_to_db()
-                mock_add.assert_not_called()
+@pytest.fixture
+def ingest_job():
+    return IngestJob(
+        session_id="test_session_id",
+        filename="test_document.pdf",
+        file_path="/tmp/source_files_test/test_document.pdf",
+    )
 
 
 @patch("rag.shutil.rmtree")
-@patch("rag.os.path.exists")
-@patch("rag.os.makedirs")
-@patch("rag.add_docs")
 @patch("rag.chunk_elements")
 @patch("rag.partition")
 @patch("rag.clean")
 @patch("rag.replace_unicode_quotes")
-@patch("builtins.open", new_callable=mock_open)
-def test_load_doc_to_db_success(
-    mock_file_open,
+def test_ingest_file_success(
     mock_replace_unicode,
     mock_clean,
     mock_partition,
     mock_chunk_elements,
-    mock_add_docs,
-    mock_makedirs,
-    mock_exists,
     mock_rmtree,
-    mock_streamlit,
-    mock_uploaded_file,
+    mock_elements,
+    ingest_job,
 ):
-    mock_streamlit.session_state.rag_docs = [mock_uploaded_file]
-    mock_streamlit.session_state.rag_sources = []
-
-    mock_element = Mock()
-    mock_element.text = "Texto de prueba"
-    mock_element.metadata.to_dict.return_value = {
-        "page_number": 1,
-        "filetype": "application/pdf",
-        "filename": "test_document.pdf",
-        "languages": ["es"],
-    }
-
-    mock_chunk = Mock()
-    mock_chunk.text = "Texto de prueba procesado"
-    mock_chunk.metadata = mock_element.metadata
-
-    mock_partition.return_value = [mock_element]
-    mock_chunk_elements.return_value = [mock_chunk]
-    mock_exists.return_value = True
+    elements, chunks = mock_elements
+    mock_partition.return_value = elements
+    mock_chunk_elements.return_value = chunks
     mock_clean.return_value = "Texto limpio"
     mock_replace_unicode.return_value = "Texto sin unicode"
 
-    load_doc_to_db()
+    vector_db = Mock()
+    vector_db.add_documents.return_value = ["id-0"]
+    rag_sources = []
+
+    ingest_file(ingest_job, vector_db, rag_sources)
 
     mock_partition.assert_called_once()
     mock_chunk_elements.assert_called_once()
-    mock_add_docs.assert_called_once()
+    vector_db.add_documents.assert_called_once()
 
-    call_args = mock_add_docs.call_args[0][0]
-    assert len(call_args) > 0
-    assert all(isinstance(doc, Document) for doc in call_args)
+    docs = vector_db.add_documents.call_args[0][0]
+    assert all(isinstance(doc, Document) for doc in docs)
+    assert docs[0].metadata["source"] == ingest_job.filename
+    assert docs[0].metadata["languages"] == "es"
 
-    mock_rmtree.assert_called_once()
-    mock_streamlit.toast.assert_called_once()
-
-    assert mock_uploaded_file.name in mock_streamlit.session_state.rag_sources
+    assert ingest_job.chunks_done == 1
+    assert rag_sources == [ingest_job.filename]
+    assert load_session_sources(ingest_job.session_id) == [ingest_job.filename]
+    mock_rmtree.assert_called_once_with("/tmp/source_files_test", ignore_errors=True)
 
 
 @patch("rag.shutil.rmtree")
-@patch("rag.os.path.exists")
-@patch("rag.os.makedirs")
 @patch("rag.partition")
-@patch("builtins.open", new_callable=mock_open)
-def test_load_doc_to_db_processing_error(
-    mock_file_open,
-    mock_partition,
-    mock_makedirs,
-    mock_exists,
-    mock_rmtree,
-    mock_streamlit,
-    mock_uploaded_file,
-):
-    mock_streamlit.session_state.rag_docs = [mock_uploaded_file]
-    mock_streamlit.session_state.rag_sources = []
-
+def test_ingest_file_processing_error(mock_partition, mock_rmtree, ingest_job):
     mock_partition.side_effect = Exception("Error de procesamiento")
-    mock_exists.return_value = True
 
-    load_doc_to_db()
+    vector_db = Mock()
+    rag_sources = []
 
-    mock_streamlit.toast.assert_called()
-    call_args = mock_streamlit.toast.call_args[0][0]
-    assert "Error al procesar el documento" in call_args
-    assert mock_uploaded_file.name in call_args
+    with pytest.raises(Exception, match="Error de procesamiento"):
+        ingest_file(ingest_job, vector_db, rag_sources)
 
+    vector_db.add_documents.assert_not_called()
     mock_rmtree.assert_called_once()
+    assert rag_sources == []
+
 
-    assert mock_uploaded_file.name not in mock_streamlit.session_state.rag_sources
+@patch("rag.shutil.rmtree")
+@patch("rag.iter_doc_batches")
+def test_ingest_file_stops_when_cancelled(
+    mock_batches, mock_rmtree, ingest_job, sample_docs
+):
+    mock_batches.return_value = (
+        batch for batch in [sample_docs[:1], sample_docs[1:]]
+    )
+
+    vector_db = Mock()
+
+    def add_documents(batch):
+        # la sesion se cierra mientras se agrega el primer lote
+        ingest_job.cancel()
+        return ["id-0"]
+
+    vector_db.add_documents.side_effect = add_documents
+    rag_sources = []
+
+    with pytest.raises(JobCancelled):
+        ingest_file(ingest_job, vector_db, rag_sources)
+
+    vector_db.add_documents.assert_called_once()
+    vector_db.delete.assert_not_called()
+    assert rag_sources == []
+    mock_rmtree.assert_called_once()
 
 
 @patch("rag.shutil.rmtree")
-@patch("rag.os.path.exists")
-@patch("rag.os.makedirs")
-@patch("rag.add_docs")
-@patch("rag.chunk_elements")
-@patch("rag.partition")
-@patch("rag.clean")
-@patch("rag.replace_unicode_quotes")
-@patch("builtins.open", new_callable=mock_open)
-def test_load_doc_to_db_multiple_files(
-    mock_file_open,
-    mock_replace_unicode,
-    mock_clean,
-    mock_partition,
-    mock_chunk_elements,
-    mock_add_docs,
-    mock_makedirs,
-    mock_exists,
-    mock_rmtree,
-    mock_streamlit,
+@patch("rag.iter_doc_batches")
+def test_ingest_file_rolls_back_partial_batches(
+    mock_batches, mock_rmtree, ingest_job, sample_docs
 ):
-    mock_file1 = Mock()
-    mock_file1.name = "doc1.pdf"
-    mock_file1.read.return_value = b"Contenido 1"
+    mock_batches.return_value = (
+        batch for batch in [sample_docs[:1], sample_docs[1:]]
+    )
 
-    mock_file2 = Mock()
-    mock_file2.name = "doc2.pdf"
-    mock_file2.read.return_value = b"Contenido 2"
+    vector_db = Mock()
+    vector_db.add_documents.side_effect = [["id-0"], Exception("429")]
+    rag_sources = []
 
-    mock_streamlit.session_state.rag_docs = [mock_file1, mock_file2]
-    mock_streamlit.session_state.rag_sources = []
+    with pytest.raises(Exception, match="429"):
+        ingest_file(ingest_job, vector_db, rag_sources)
 
-    mock_element = Mock()
-    mock_element.text = "Texto"
-    mock_element.metadata.to_dict.return_value = {
-        "page_number": 1,
-        "filetype": "application/pdf",
-        "filename": "test.pdf",
-        "languages": ["es"],
-    }
+    vector_db.delete.assert_called_once_with(ids=["id-0"])
+    assert ingest_job.chunks_done == 0
+    assert rag_sources == []
+    assert load_session_sources(ingest_job.session_id) == []
 
-    mock_chunk = Mock()
-    mock_chunk.text = "Texto procesado"
-    mock_chunk.metadata = mock_element.metadata
 
-    mock_partition.return_value = [mock_element]
-    mock_chunk_elements.return_value = [mock_chunk]
-    mock_exists.return_value = True
-    mock_clean.return_value = "Texto limpio"
-    mock_replace_unicode.return_value = "Texto sin unicode"
+def make_element(page_number, text="Texto"):
+    element = Mock()
+    element.text = text
+    element.metadata.page_number = page_number
+    return element
 
-    load_doc_to_db()
 
-    assert mock_partition.call_count == 2
-    assert len(mock_streamlit.session_state.rag_sources) == 2
-    assert "doc1.pdf" in mock_streamlit.session_state.rag_sources
-    assert "doc2.pdf" in mock_streamlit.session_state.rag_sources
+def test_find_scanned_pages_blank_pdf(tmp_path):
+    writer = PdfWriter()
+    writer.add_blank_page(width=200, height=200)
+    writer.add_blank_page(width=200, height=200)
+    file_path = tmp_path / "escaneado.pdf"
+    with open(file_path, "wb") as file:
+        writer.write(file)
 
+    assert find_scanned_pages(str(file_path)) == [1, 2]
+    assert find_scanned_pages(str(file_path), 2, 2) == [2]
 
-def test_load_doc_to_db_empty_after_filtering(mock_streamlit, mock_uploaded_file):
-    mock_streamlit.session_state.rag_sources = [mock_uploaded_file.name]
-    mock_streamlit.session_state.rag_docs = [mock_uploaded_file]
 
-    with patch("rag.add_docs") as mock_add:
-        with patch("rag.os.path.exists", return_value=False):
-            with patch("rag.os.makedirs"):
-                load_doc_to_db()
+@patch("rag.partition_pdf_pages")
+@patch("rag.find_scanned_pages", return_value=[])
+def test_partition_pdf_range_text_pages_use_fast(mock_find, mock_pages):
+    mock_pages.return_value = [make_element(1), make_element(2), make_element(3)]
+    timings = {}
+
+    elements = partition_pdf_range("/tmp/doc.pdf", 1, 3, timings)
+
+    mock_pages.assert_called_once_with("/tmp/doc.pdf", 1, 3, "fast")
+    assert len(elements) == 3
+    assert "fast" in timings
+    assert OCR_STRATEGY not in timings
+
+
+@patch("rag.partition_pdf_pages")
+@patch("rag.find_scanned_pages", return_value=[2])
+def test_partition_pdf_range_ocr_only_scanned(mock_find, mock_pages):
+    # "fast" no saca texto util de la pagina escaneada, se descarta
+    def partition_pages(file_path, first_page, last_page, strategy):
+        if strategy == "fast":
+            return [make_element(1), make_element(2, "basura"), make_element(3)]
+        return [make_element(first_page, "Texto OCR")]
+
+    mock_pages.side_effect = partition_pages
+    timings = {}
+
+    elements = partition_pdf_range("/tmp/doc.pdf", 1, 3, timings)
+
+    mock_pages.assert_any_call("/tmp/doc.pdf", 2, 2, OCR_STRATEGY)
+    assert [element.metadata.page_number for element in elements] == [1, 2, 3]
+    assert elements[1].text == "Texto OCR"
+    assert "fast" in timings
+    assert OCR_STRATEGY in timings
+
+
+@patch("rag.partition_pdf_pages")
+@patch("rag.find_scanned_pages", return_value=[1, 2])
+def test_partition_pdf_range_scanned_skips_fast(mock_find, mock_pages):
+    mock_pages.side_effect = lambda file_path, first, last, strategy: [
+        make_element(first)
+    ]
+
+    elements = partition_pdf_range("/tmp/doc.pdf", 1, 2)
+
+    assert mock_pages.call_count == 2
+    assert all(call[0][3] == OCR_STRATEGY for call in mock_pages.call_args_list)
+    assert [element.metadata.page_number for element in elements] == [1, 2]
+
+
+@patch("rag.partition_pdf_range")
+def test_iter_element_ranges_splits_pdf(mock_range, tmp_path):
+    writer = PdfWriter()
+    for _ in range(5):
+        writer.add_blank_page(width=200, height=200)
+    file_path = str(tmp_path / "largo.pdf")
+    with open(file_path, "wb") as file:
+        writer.write(file)
+
+    ranges = list(iter_element_ranges(file_path, pages_per_range=2))
+
+    assert len(ranges) == 3
+    assert [call[0][1:3] for call in mock_range.call_args_list] == [
+        (1, 2),
+        (3, 4),
+        (5, 5),
+    ]
+
+
+@patch("rag.partition_pdf_range")
+@patch("rag.partition")
+def test_iter_element_ranges_non_pdf(mock_partition, mock_range):
+    timings = {}
+
+    ranges = list(iter_element_ranges("/tmp/doc.docx", timings))
+
+    assert ranges == [mock_partition.return_value]
+    mock_partition.assert_called_once_with(filename="/tmp/doc.docx")
+    mock_range.assert_not_called()
+    assert "auto" in timings
+
+
+@patch("rag.chunk_elements")
+def test_iter_chunk_batches_keeps_chunk_ids(mock_chunk_elements):
+    def make_chunk(page_number):
+        chunk = Mock()
+        chunk.text = "Texto"
+        chunk.metadata.to_dict.return_value = {"page_number": page_number}
+        return chunk
+
+    # un rango con 3 chunks y otro con 2
+    mock_chunk_elements.side_effect = [
+        [make_chunk(1), make_chunk(1), make_chunk(2)],
+        [make_chunk(3), make_chunk(4)],
+    ]
+    element_ranges = [[make_element(1)], [make_element(3)]]
+
+    batches = list(iter_chunk_batches(element_ranges, "doc.pdf", batch_size=2))
 
-                mock_add.assert_not_called()
-                mock_streamlit.toast.assert_not_called()
+    docs = [doc for batch in batches for doc in batch]
+    assert [len(batch) for batch in batches] == [2, 1, 2]
+    assert [doc.metadata["chunk_id"] for doc in docs] == [0, 1, 2, 3, 4]
+    assert [doc.metadata["page_number"] for doc in docs] == [1, 1, 2, 3, 4]
@@ -0,0 +1,129 @@
+import threading
+from time import sleep
+from unittest.mock import Mock
+
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+import ratelimit
+from ratelimit import (
+    BULK,
+    CHAT_TOKEN_ESTIMATE,
+    INTERACTIVE,
+    KeyScheduler,
+    ScheduledEmbeddings,
+    UsageSettler,
+    get_scheduler,
+)
+
+
+def wait_until_queued(scheduler, name, count=1):
+    while scheduler.stats()["queued"][name] < count:
+        sleep(0.005)
+
+
+def test_interactive_goes_before_bulk():
+    # 600 por minuto: una request cada 0.1s
+    scheduler = KeyScheduler(requests_per_minute=600, tokens_per_minute=10**6)
+    for _ in range(600):
+        scheduler.acquire(BULK, blocking=False)
+
+    order = []
+
+    def acquire(priority, name):
+        scheduler.acquire(priority)
+        order.append(name)
+
+    bulk = threading.Thread(target=acquire, args=(BULK, "bulk"))
+    bulk.start()
+    wait_until_queued(scheduler, "bulk")
+
+    interactive = threading.Thread(target=acquire, args=(INTERACTIVE, "interactive"))
+    interactive.start()
+    wait_until_queued(scheduler, "interactive")
+
+    bulk.join()
+    interactive.join()
+
+    assert order == ["interactive", "bulk"]
+    stats = scheduler.stats()
+    assert stats["queued"] == {"interactive": 0, "bulk": 0}
+    assert stats["wait_max_s"]["bulk"] > stats["wait_max_s"]["interactive"] > 0
+
+
+def test_non_blocking_acquire_without_budget():
+    scheduler = KeyScheduler(requests_per_minute=2, tokens_per_minute=1000)
+
+    assert scheduler.acquire(tokens=600, blocking=False)
+    # queda cuota de requests pero no de tokens
+    assert not scheduler.acquire(tokens=600, blocking=False)
+    assert scheduler.stats()["queued"] == {"interactive": 0, "bulk": 0}
+
+
+def test_waits_for_token_budget():
+    scheduler = KeyScheduler(requests_per_minute=1000, tokens_per_minute=60_000)
+    scheduler.acquire(tokens=60_000)
+
+    # 1000 tokens por segundo: 100 tokens tardan ~0.1s
+    scheduler.acquire(tokens=100)
+
+    assert 0.05 < scheduler.stats()["wait_max_s"]["interactive"] < 1
+
+
+def test_oversized_call_is_capped_to_the_budget():
+    scheduler = KeyScheduler(requests_per_minute=10, tokens_per_minute=100)
+
+    assert scheduler.acquire(tokens=10**6, blocking=False)
+
+
+def test_zero_means_no_limit():
+    scheduler = KeyScheduler(requests_per_minute=0, tokens_per_minute=0)
+
+    for _ in range(100):
+        assert scheduler.acquire(BULK, tokens=10**6, blocking=False)
+    scheduler.settle(10**6)
+    assert scheduler.acquire(tokens=10**6, blocking=False)
+
+    only_tokens = KeyScheduler(requests_per_minute=0, tokens_per_minute=100)
+    assert only_tokens.acquire(tokens=100, blocking=False)
+    assert not only_tokens.acquire(tokens=100, blocking=False)
+
+
+def test_settle_corrects_reservation():
+    scheduler = KeyScheduler(requests_per_minute=60, tokens_per_minute=10**6)
+    scheduler.acquire(tokens=CHAT_TOKEN_ESTIMATE)
+
+    usage = {"input_tokens": 4000, "output_tokens": 1000, "total_tokens": 5000}
+    UsageSettler(scheduler).on_llm_end(
+        LLMResult(
+            generations=[
+                [ChatGeneration(message=AIMessage(content="hola", usage_metadata=usage))]
+            ]
+        )
+    )
+
+    # sin el ajuste quedarian 10**6 - CHAT_TOKEN_ESTIMATE (mas lo que se recargo)
+    assert scheduler.stats()["available_tokens"] < 10**6 - 4500
+
+
+def test_scheduled_embeddings_priorities():
+    scheduler = Mock()
+    embeddings = Mock()
+    scheduled = ScheduledEmbeddings(embeddings, scheduler)
+
+    scheduled.embed_documents(["a" * 400] * 150)
+    scheduled.embed_query("a" * 40)
+
+    assert scheduler.acquire.call_args_list[0].args == (BULK,)
+    assert scheduler.acquire.call_args_list[0].kwargs == {"tokens": 15000, "requests": 2}
+    assert scheduler.acquire.call_args_list[1].args == (INTERACTIVE,)
+    embeddings.embed_documents.assert_called_once()
+    embeddings.embed_query.assert_called_once_with("a" * 40)
+
+
+def test_get_scheduler_is_shared_per_key(monkeypatch):
+    monkeypatch.setattr(ratelimit, "_schedulers", {})
+
+    assert get_scheduler("key-1") is get_scheduler("key-1")
+    assert get_scheduler("key-1") is not get_scheduler("key-2")
+    assert set(ratelimit.all_scheduler_stats()) == {"...ey-1", "...ey-2"}
@@ -0,0 +1,195 @@
+from unittest.mock import Mock, patch
+
+import pytest
+from starlette.testclient import TestClient
+
+import chat_store
+import ratelimit
+import usage
+import server
+from engine import Engine, EngineError, key_owner
+
+HEADERS = {"X-Gemini-Api-Key": "test_api_key"}
+OWNER = key_owner("test_api_key")
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = Engine()
+    monkeypatch.setattr(server, "engine", engine)
+    return engine
+
+
+@pytest.fixture
+def client(engine):
+    return TestClient(server.app)
+
+
+def test_create_session(client):
+    response = client.post("/sessions")
+
+    assert response.status_code == 201
+    assert response.json()["session_id"]
+
+
+def test_requires_api_key(client):
+    response = client.get("/sessions/s1/documents")
+
+    assert response.status_code == 400
+    assert "X-Gemini-Api-Key" in response.json()["error"]
+
+
+def test_upload_documents(client, engine):
+    job = Mock(
+        job_id="j1",
+        filename="doc1.pdf",
+        status="en cola",
+        chunks_done=0,
+        error=None,
+        timings={},
+    )
+
+    with patch.object(engine, "ingest", return_value=job) as mock_ingest:
+        response = client.post(
+            "/sessions/s1/documents",
+            headers=HEADERS,
+            files=[("files", ("doc1.pdf", b"Contenido", "application/pdf"))],
+        )
+
+    assert response.status_code == 202
+    assert response.json()["jobs"][0]["filename"] == "doc1.pdf"
+    session, filename, data = mock_ingest.call_args[0]
+    assert session.session_id == "s1"
+    assert (filename, data) == ("doc1.pdf", b"Contenido")
+
+
+def test_list_documents(client):
+    response = client.get("/sessions/s1/documents", headers=HEADERS)
+
+    assert response.json() == {"sources": [], "jobs": [], "rag_ready": False}
+
+
+def test_session_of_other_key(client, engine):
+    engine.get_session("s1", "test_api_key").rag_sources.append("contrato.pdf")
+    other = {"X-Gemini-Api-Key": "otra_key"}
+
+    assert client.get("/sessions/s1/documents", headers=other).status_code == 404
+    assert client.get("/sessions/s1/usage", headers=other).status_code == 404
+    assert client.delete("/sessions/s1", headers=other).status_code == 404
+    assert client.delete("/sessions/s1").status_code == 400
+    assert engine.session_ids() == ["s1"]
+
+    assert client.delete("/sessions/s1", headers=HEADERS).status_code == 204
+    assert engine.session_ids() == []
+
+
+def test_chat_streams_sse(client, engine):
+    def stream_chat(session, conversation_id, prompt, use_rag, on_tool_call):
+        def stream():
+            on_tool_call("search")
+            yield "Hola "
+            yield "mundo"
+
+        return stream()
+
+    with patch.object(engine, "stream_chat", side_effect=stream_chat):
+        response = client.post(
+            "/sessions/s1/chat",
+            headers=HEADERS,
+            json={"conversation_id": "conv1", "message": "test"},
+        )
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        line.removeprefix("event: ")
+        for line in response.text.splitlines()
+        if line.startswith("event: ")
+    ]
+    assert events == ["tool", "token", "token", "done"]
+    assert 'data: {"text": "Hola "}' in response.text
+
+
+def test_chat_engine_error(client, engine):
+    with patch.object(
+        engine, "stream_chat", side_effect=EngineError("No hay documentos")
+    ):
+        response = client.post(
+            "/sessions/s1/chat",
+            headers=HEADERS,
+            json={"conversation_id": "conv1", "message": "test", "use_rag": True},
+        )
+
+    assert response.status_code == 400
+    assert response.json() == {"error": "No hay documentos"}
+
+
+def test_list_messages(client):
+    first_id = chat_store.add_message("conv1", "user", "Hola", OWNER)
+    chat_store.add_message("conv1", "assistant", "Hola, soy DocuChat", OWNER)
+
+    response = client.get(
+        "/conversations/conv1/messages", params={"limit": 1}, headers=HEADERS
+    )
+    assert [m["content"] for m in response.json()["messages"]] == [
+        "Hola, soy DocuChat"
+    ]
+
+    response = client.get(
+        "/conversations/conv1/messages",
+        params={"before_id": first_id + 1},
+        headers=HEADERS,
+    )
+    assert [m["content"] for m in response.json()["messages"]] == ["Hola"]
+
+
+def test_invalid_parameters(client):
+    for params in ({"limit": "diez"}, {"limit": -1}, {"limit": 1000}, {"before_id": "x"}):
+        response = client.get(
+            "/conversations/conv1/messages", params=params, headers=HEADERS
+        )
+        assert response.status_code == 400
+
+    assert client.get("/usage", params={"since": "ayer"}).status_code == 400
+
+    response = client.post("/sessions/s1/chat", headers=HEADERS, content=b"{no json")
+    assert response.status_code == 400
+    response = client.post("/sessions/s1/chat", headers=HEADERS, json=["hola"])
+    assert response.status_code == 400
+
+
+def test_list_messages_of_other_key(client):
+    chat_store.add_message("conv1", "user", "Hola", key_owner("otra_key"))
+
+    response = client.get("/conversations/conv1/messages", headers=HEADERS)
+
+    assert response.status_code == 404
+    assert client.get("/conversations/conv1/messages").status_code == 400
+
+
+def test_rate_limits(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "_schedulers", {})
+    ratelimit.get_scheduler("test_api_key")
+
+    response = client.get("/limits")
+
+    assert response.status_code == 200
+    limits = response.json()["keys"]["..._key"]
+    assert limits["queued"] == {"interactive": 0, "bulk": 0}
+
+
+def test_session_usage(client):
+    usage.record_usage("s1", usage.CHAT, "gemini-2.5-flash", 100, 20, 0.5)
+    usage.record_usage("s1", usage.EMBED_QUERY, usage.EMBEDDING_MODEL, 10, 0, 0.1)
+    usage.record_usage("s2", usage.CHAT, "gemini-2.5-flash", 5, 5, 0.1)
+
+    body = client.get("/sessions/s1/usage", headers=HEADERS).json()
+
+    assert body["budget"] == "ok"
+    assert body["total_tokens"] == 130
+    assert {stage["stage"] for stage in body["stages"]} == {"chat", "embed_query"}
+
+    totals = client.get("/usage?by=session_id").json()["totals"]
+    assert [(t["session_id"], t["total_tokens"]) for t in totals] == [
+        ("s1", 130),
+        ("s2", 10),
+    ]
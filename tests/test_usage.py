@@ -0,0 +1,129 @@
+import io
+from unittest.mock import Mock
+from uuid import uuid4
+
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+import usage
+from usage import (
+    ANSWER,
+    BUDGET_HARD,
+    BUDGET_OK,
+    BUDGET_SOFT,
+    CHAT,
+    EMBED_DOCUMENTS,
+    EMBED_QUERY,
+    EMBEDDING_MODEL,
+    TOOL_TURN,
+    UsageEmbeddings,
+    UsageRecorder,
+    budget_status,
+    ingest_budget_status,
+    cost_usd,
+    export_csv,
+    record_usage,
+    session_tokens,
+    usage_totals,
+)
+
+
+def llm_result(input_tokens, output_tokens):
+    message = AIMessage(
+        content="respuesta",
+        usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        },
+        response_metadata={"model_name": "gemini-2.5-flash"},
+    )
+    return LLMResult(generations=[[ChatGeneration(message=message)]])
+
+
+def test_recorder_stages():
+    recorder = UsageRecorder("s1", "gemini-2.5-flash")
+
+    for run_id, tags in ((uuid4(), None), (uuid4(), ["seq:step:1"])):
+        recorder.on_chat_model_start({}, [], run_id=run_id)
+        recorder.on_llm_end(llm_result(100, 20), run_id=run_id, tags=tags)
+    recorder.on_llm_end(llm_result(300, 50), run_id=uuid4(), tags=[ANSWER])
+
+    stages = {total["stage"]: total for total in usage_totals(["stage"])}
+    assert stages[CHAT]["calls"] == 1
+    assert stages[TOOL_TURN]["input_tokens"] == 100
+    assert stages[ANSWER]["total_tokens"] == 350
+    assert session_tokens("s1") == 590
+
+
+def test_usage_embeddings():
+    embeddings = Mock()
+    embeddings.embed_documents.return_value = [[0.1], [0.2]]
+    tracked = UsageEmbeddings(embeddings, "s1")
+
+    assert tracked.embed_documents(["a" * 400, "b" * 40]) == [[0.1], [0.2]]
+    tracked.embed_query("c" * 40)
+
+    totals = {
+        total["stage"]: total for total in usage_totals(["stage"], session_id="s1")
+    }
+    assert totals[EMBED_DOCUMENTS]["input_tokens"] == 110
+    assert totals[EMBED_QUERY]["input_tokens"] == 10
+
+
+def test_totals_cost_by_session():
+    record_usage("s1", CHAT, "gemini-2.5-flash", 1_000_000, 0, 1.0)
+    record_usage("s1", EMBED_DOCUMENTS, EMBEDDING_MODEL, 1_000_000, 0, 2.0)
+    record_usage("s2", CHAT, "gemini-2.5-flash", 10, 1_000_000, 0.5)
+
+    s1, s2 = sorted(usage_totals(["session_id"]), key=lambda t: t["session_id"])
+    assert s1["calls"] == 2
+    assert s1["latency_s"] == 3.0
+    assert s1["cost_usd"] == pytest.approx(0.45)
+    assert s2["cost_usd"] == pytest.approx(cost_usd("gemini-2.5-flash", 10, 1_000_000))
+
+
+def test_budget_status(monkeypatch):
+    monkeypatch.setattr(usage, "SESSION_SOFT_TOKENS", 100)
+    monkeypatch.setattr(usage, "SESSION_HARD_TOKENS", 200)
+
+    assert budget_status("s1") == BUDGET_OK
+    record_usage("s1", CHAT, "gemini-2.5-flash", 90, 10, 0.1)
+    assert budget_status("s1") == BUDGET_SOFT
+    record_usage("s1", CHAT, "gemini-2.5-flash", 100, 0, 0.1)
+    assert budget_status("s1") == BUDGET_HARD
+
+    # 0 desactiva los limites
+    monkeypatch.setattr(usage, "SESSION_HARD_TOKENS", 0)
+    monkeypatch.setattr(usage, "SESSION_SOFT_TOKENS", 0)
+    assert budget_status("s1") == BUDGET_OK
+
+
+def test_ingestion_has_its_own_budget(monkeypatch):
+    monkeypatch.setattr(usage, "SESSION_SOFT_TOKENS", 100)
+    monkeypatch.setattr(usage, "SESSION_INGEST_TOKENS", 1000)
+
+    # un documento grande no afecta el presupuesto del chat
+    record_usage("s1", EMBED_DOCUMENTS, EMBEDDING_MODEL, 999, 0, 1.0)
+    record_usage("s1", CHAT, "gemini-2.5-flash", 40, 10, 0.1)
+    assert session_tokens("s1") == 50
+    assert session_tokens("s1", ingest=True) == 999
+    assert budget_status("s1") == BUDGET_OK
+    assert ingest_budget_status("s1") == BUDGET_OK
+
+    record_usage("s1", EMBED_DOCUMENTS, EMBEDDING_MODEL, 1, 0, 0.1)
+    assert ingest_budget_status("s1") == BUDGET_HARD
+    assert budget_status("s1") == BUDGET_OK
+
+
+def test_export_csv():
+    record_usage("s1", CHAT, "gemini-2.5-flash", 10, 5, 0.1)
+    record_usage("s2", CHAT, "gemini-2.5-flash", 20, 5, 0.1)
+
+    file = io.StringIO()
+    export_csv(file, by=["stage"])
+
+    lines = file.getvalue().splitlines()
+    assert lines[0].startswith("stage,calls,input_tokens")
+    assert lines[1].startswith("chat,2,30,10,40")
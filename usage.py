@@ -0,0 +1,289 @@
+# Consumo de tokens por llamada a Gemini, agregado por sesion y etapa.
+#
+#   python usage.py --by stage --csv usage.csv
+#
+# Cada llamada (generacion, reescritura de la consulta, turnos de herramientas
+# y embeddings) queda en la tabla `usage` de la misma base que el historial,
+# asi los presupuestos por sesion valen para todos los procesos del servidor.
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+from contextlib import closing
+from time import monotonic, time
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+import chat_store
+from ratelimit import estimate_tokens
+
+# Etapas
+CHAT = "chat"  # primera respuesta del agente
+TOOL_TURN = "tool_turn"  # llamadas del agente despues de usar una herramienta
+REWRITE = "rewrite"  # reescritura de la consulta con el historial (RAG)
+ANSWER = "answer"  # respuesta con el contexto recuperado (RAG)
+EMBED_DOCUMENTS = "embed_documents"  # ingesta
+EMBED_QUERY = "embed_query"  # busqueda en la coleccion
+
+EMBEDDING_MODEL = "gemini-embedding-001"
+# USD por millon de tokens (entrada, salida)
+PRICES_PER_MILLION = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    EMBEDDING_MODEL: (0.15, 0.0),
+}
+
+# Tokens por sesion, 0 (por defecto) desactiva el limite. Se leen al importar.
+# La ingesta tiene su propio limite: un PDF grande no debe dejar sin chat a la sesion
+SESSION_SOFT_TOKENS = int(os.environ.get("DOCUCHAT_SESSION_SOFT_TOKENS", 0))
+SESSION_HARD_TOKENS = int(os.environ.get("DOCUCHAT_SESSION_HARD_TOKENS", 0))
+SESSION_INGEST_TOKENS = int(os.environ.get("DOCUCHAT_SESSION_INGEST_TOKENS", 0))
+
+# Estado del presupuesto
+BUDGET_OK = "ok"
+BUDGET_SOFT = "soft"  # se responde con menos contexto
+BUDGET_HARD = "hard"  # se rechazan nuevas llamadas
+
+GROUP_COLUMNS = ("session_id", "stage", "model")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    model TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    latency_s REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_by_session ON usage (session_id);
+"""
+
+
+def _connect():
+    conn = sqlite3.connect(chat_store.CHAT_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def record_usage(session_id, stage, model, input_tokens, output_tokens, latency_s):
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT INTO usage (session_id, stage, model, input_tokens,"
+            " output_tokens, latency_s, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                session_id,
+                stage,
+                model,
+                input_tokens,
+                output_tokens,
+                latency_s,
+                time(),
+            ),
+        )
+
+
+def cost_usd(model, input_tokens, output_tokens):
+    input_price, output_price = PRICES_PER_MILLION.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def usage_totals(by=GROUP_COLUMNS, session_id=None, since=None):
+    """Llamadas, tokens, latencia y costo agrupados por las columnas `by`."""
+    by = [column for column in GROUP_COLUMNS if column in by]
+    # el costo depende del modelo, se agrupa por modelo y se suma despues
+    columns = ", ".join(dict.fromkeys([*by, "model"]))
+    query = (
+        f"SELECT {columns}, COUNT(*) AS calls,"
+        " SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens,"
+        " SUM(latency_s) AS latency_s FROM usage WHERE 1 = 1"
+    )
+    params = []
+    if session_id is not None:
+        query += " AND session_id = ?"
+        params.append(session_id)
+    if since is not None:
+        query += " AND created_at >= ?"
+        params.append(since)
+    query += f" GROUP BY {columns}"
+
+    with closing(_connect()) as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    totals = {}
+    for row in rows:
+        key = tuple(row[column] for column in by)
+        total = totals.setdefault(
+            key,
+            {
+                **dict(zip(by, key)),
+                "calls": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "total_tokens": 0,
+                "latency_s": 0.0,
+                "cost_usd": 0.0,
+            },
+        )
+        total["calls"] += row["calls"]
+        total["input_tokens"] += row["input_tokens"]
+        total["output_tokens"] += row["output_tokens"]
+        total["total_tokens"] += row["input_tokens"] + row["output_tokens"]
+        total["latency_s"] += row["latency_s"]
+        total["cost_usd"] += cost_usd(
+            row["model"], row["input_tokens"], row["output_tokens"]
+        )
+
+    return sorted(totals.values(), key=lambda total: -total["total_tokens"])
+
+
+def session_tokens(session_id, ingest=False):
+    """Tokens del chat de la sesion, o de su ingesta con `ingest=True`."""
+    operator = "=" if ingest else "!="
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT COALESCE(SUM(input_tokens + output_tokens), 0)"
+            f" FROM usage WHERE session_id = ? AND stage {operator} ?",
+            (session_id, EMBED_DOCUMENTS),
+        ).fetchone()
+
+    return row[0]
+
+
+def budget_status(session_id):
+    """Presupuesto del chat: generacion, herramientas, RAG y embeddings de consultas."""
+    tokens = session_tokens(session_id)
+    if SESSION_HARD_TOKENS and tokens >= SESSION_HARD_TOKENS:
+        return BUDGET_HARD
+    if SESSION_SOFT_TOKENS and tokens >= SESSION_SOFT_TOKENS:
+        return BUDGET_SOFT
+    return BUDGET_OK
+
+
+def ingest_budget_status(session_id):
+    tokens = session_tokens(session_id, ingest=True)
+    if SESSION_INGEST_TOKENS and tokens >= SESSION_INGEST_TOKENS:
+        return BUDGET_HARD
+    return BUDGET_OK
+
+
+def export_csv(file, by=GROUP_COLUMNS, since=None):
+    by = [column for column in GROUP_COLUMNS if column in by]
+    fields = [
+        *by,
+        "calls",
+        "input_tokens",
+        "output_tokens",
+        "total_tokens",
+        "latency_s",
+        "cost_usd",
+    ]
+    writer = csv.DictWriter(file, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(usage_totals(by, since=since))
+
+
+class UsageRecorder(BaseCallbackHandler):
+    """Registra los tokens de cada llamada al modelo de una respuesta.
+
+    En el agente la primera llamada es CHAT y las siguientes TOOL_TURN; en la
+    cadena RAG la etapa viene en los tags del modelo (REWRITE o ANSWER). La
+    latencia incluye la espera en el rate limiter.
+    """
+
+    def __init__(self, session_id, model):
+        self.session_id = session_id
+        self.model = model
+        self.calls = 0
+        self._started_at = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started_at[run_id] = monotonic()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started_at[run_id] = monotonic()
+
+    def on_llm_end(self, response, *, run_id, tags=None, **kwargs):
+        started_at = self._started_at.pop(run_id, None)
+        latency = monotonic() - started_at if started_at is not None else 0.0
+
+        stage = next((tag for tag in tags or () if tag in (REWRITE, ANSWER)), None)
+        if stage is None:
+            stage = CHAT if self.calls == 0 else TOOL_TURN
+        self.calls += 1
+
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if usage:
+                    record_usage(
+                        self.session_id,
+                        stage,
+                        message.response_metadata.get("model_name") or self.model,
+                        usage["input_tokens"],
+                        usage["output_tokens"],
+                        latency,
+                    )
+
+
+class UsageEmbeddings(Embeddings):
+    """Registra los embeddings de una sesion.
+
+    La API de embeddings no informa tokens, se estiman por caracteres.
+    """
+
+    def __init__(self, embeddings, session_id):
+        self.embeddings = embeddings
+        self.session_id = session_id
+
+    def _record(self, stage, texts, started_at):
+        record_usage(
+            self.session_id,
+            stage,
+            EMBEDDING_MODEL,
+            sum(estimate_tokens(text) for text in texts),
+            0,
+            monotonic() - started_at,
+        )
+
+    def embed_documents(self, texts):
+        started_at = monotonic()
+        embeddings = self.embeddings.embed_documents(texts)
+        self._record(EMBED_DOCUMENTS, texts, started_at)
+        return embeddings
+
+    def embed_query(self, text):
+        started_at = monotonic()
+        embedding = self.embeddings.embed_query(text)
+        self._record(EMBED_QUERY, [text], started_at)
+        return embedding
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Exporta el consumo de tokens de DocuChat"
+    )
+    parser.add_argument(
+        "--by",
+        nargs="+",
+        choices=GROUP_COLUMNS,
+        default=list(GROUP_COLUMNS),
+        help="columnas por las que se agrupa",
+    )
+    parser.add_argument("--since", type=float, help="timestamp unix desde el que contar")
+    parser.add_argument("--csv", help="archivo de salida (por defecto stdout)")
+    args = parser.parse_args(argv)
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            export_csv(file, args.by, args.since)
+    else:
+        export_csv(sys.stdout, args.by, args.since)
+
+
+if __name__ == "__main__":
+    main()